@@ -0,0 +1,284 @@
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from gym_cto.envs import CtoEnv, eCtoEnv, VectorCtoEnv, VectorECtoEnv
+
+"""
+Throughput benchmarks of the CTO environments
+
+Times initialize(), reset(), step() and the reward calculation of CtoEnv and
+eCtoEnv, single and vectorized, over a grid of settings. Compiled backends of
+eCtoEnv are first checked to step exactly like the numpy one from the same
+seed. Every case reports
+calls/sec, sub-steps/sec, per-call latency percentiles and the peak memory
+traced while stepping. Results are written as JSON together with the commit
+they were measured on, and --compare prints the step throughput ratios against
+an earlier results file.
+
+    python benchmarks/benchmark.py --targets 10 100 --agents 10 50 --out results.json
+    python benchmarks/benchmark.py --out new.json --compare results.json
+    python benchmarks/benchmark.py --envs ecto --numEnvs 0 --backends numpy numba --updateRate 100
+    python benchmarks/benchmark.py --envs ecto --numEnvs 0 --gridSize 10000 --targets 20000 --tileSize 0 60
+"""
+
+PERCENTILES = (50, 90, 99)
+
+#Settings only eCtoEnv takes
+ECTO_ONLY = ('agents', 'mark')
+
+
+def commitId():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Calls fn() count times and returns the per-call latencies in seconds
+def timeCalls(fn, count):
+    latencies = np.empty(count)
+    for i in range(count):
+        start = time.perf_counter()
+        fn()
+        latencies[i] = time.perf_counter() - start
+    return latencies
+
+
+def summarize(latencies, subSteps=1):
+    total = latencies.sum()
+    summary = {
+        'calls': len(latencies),
+        'total_s': total,
+        'calls_per_s': len(latencies) / total if total else float('inf'),
+        'sub_steps_per_s': len(latencies)*subSteps / total if total else float('inf'),
+    }
+    for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        summary['p%d_ms' % p] = value*1000.0
+    return summary
+
+
+# Peak bytes traced by tracemalloc over count calls of fn(), run apart from the timings it would slow down
+def peakMemory(fn, count):
+    tracemalloc.start()
+    try:
+        for _ in range(count):
+            fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Environment, step function and reward function of one case. Actions are drawn ahead of time
+def makeCase(kind, numEnvs, config, seed):
+    rng = np.random.default_rng(seed)
+    if numEnvs:
+        env = (VectorECtoEnv if kind == 'ecto' else VectorCtoEnv)(numEnvs)
+        env.seed(seed)
+        env.initialize(**config)
+        env.reset()
+        actions = rng.uniform(0.0, (env.gridWidth, env.gridHeight), size=(64, numEnvs, env.numAgents, 2))
+
+        def step(k):
+            env.step(actions[k % len(actions)])
+
+        def reset():
+            for b in range(numEnvs):
+                env.resetEnv(b)
+
+        return env, step, reset, env.calculateRewards
+
+    env = (eCtoEnv if kind == 'ecto' else CtoEnv)()
+    env.seed(seed)
+    env.initialize(**config)
+    env.reset()
+    shape = (env.numAgents, 2) if kind == 'ecto' else (2,)
+    actions = rng.uniform(0.0, (env.gridWidth, env.gridHeight), size=(64,) + shape)
+
+    def step(k):
+        if env.step(actions[k % len(actions)])[2]:
+            env.reset()
+
+    #eCtoEnv caches the rewards of the current positions, so every timed call drops them first
+    def rewards():
+        if kind == 'ecto':
+            env.invalidatePairs()
+            return env.calculateAgentRewards()
+        return env.targetsInRange()
+
+    return env, step, lambda: env.reset(options={}), rewards
+
+
+# Steps a numpy and a compiled eCtoEnv through the same seeded episode and raises when their rewards,
+# observations or random streams part
+def checkParity(config, args):
+    rng = np.random.default_rng(args.seed)
+    envs = []
+    for backend in ('numpy', config['backend']):
+        env = eCtoEnv()
+        env.seed(args.seed)
+        env.initialize(**dict(config, backend=backend))
+        env.reset()
+        envs.append(env)
+
+    for k in range(args.paritySteps):
+        action = rng.uniform(0.0, (envs[0].gridWidth, envs[0].gridHeight), size=(envs[0].numAgents, 2))
+        (obs, reward, done, _), (otherObs, otherReward, _, _) = [env.step(action) for env in envs]
+        if not (np.array_equal(reward, otherReward) and np.array_equal(obs, otherObs)):
+            raise RuntimeError("The %s backend parts from the numpy backend at step %d" % (config['backend'], k))
+        if done:
+            for env in envs:
+                env.reset()
+
+    if envs[0].np_random.random() != envs[1].np_random.random():
+        raise RuntimeError("The %s backend consumed a different part of the random stream" % config['backend'])
+
+
+def runCase(kind, numEnvs, config, args):
+    if config.get('backend', 'numpy') != 'numpy':
+        checkParity(config, args)
+
+    batch = max(numEnvs, 1)
+    initialize = (VectorECtoEnv if kind == 'ecto' else VectorCtoEnv)(numEnvs) if numEnvs else \
+                    (eCtoEnv if kind == 'ecto' else CtoEnv)()
+    initialize.seed(args.seed)
+    result = {'initialize': summarize(timeCalls(lambda: initialize.initialize(**config), args.initializeCalls))}
+
+    env, step, reset, rewards = makeCase(kind, numEnvs, config, args.seed)
+    result['reset'] = summarize(timeCalls(reset, args.resetCalls), batch)
+    result['calculateAgentRewards'] = summarize(timeCalls(rewards, args.rewardCalls), batch)
+
+    counter = itertools.count()
+    for _ in range(args.warmup):
+        step(next(counter))
+    result['step'] = summarize(timeCalls(lambda: step(next(counter)), args.stepCalls), batch*config['updateRate'])
+    result['step']['peak_memory_bytes'] = peakMemory(lambda: step(next(counter)), args.memoryCalls)
+
+    return result
+
+
+# Every combination of the swept settings, settings eCtoEnv alone takes are dropped for CtoEnv
+def cases(args):
+    names = ('targets', 'agents', 'sensorRange', 'updateRate', 'compact', 'mark')
+    seen = set()
+    for kind in args.envs:
+        for numEnvs in args.numEnvs:
+            for values in itertools.product(args.targets, args.agents, args.sensorRange, args.updateRate,
+                                            args.compact, args.mark, args.gridSize or [None]):
+                config = dict(zip(names, values))
+                if values[-1] is not None:
+                    config['gridWidth'] = config['gridHeight'] = values[-1]
+                if kind == 'cto':
+                    for name in ECTO_ONLY:
+                        config.pop(name)
+                config['totalSimTime'] = args.totalSimTime
+                if kind == 'ecto' and config['compact']:
+                    config['compactFormat'] = args.compactFormat
+
+                #Only the single eCtoEnv has compiled backends and tiles
+                single = kind == 'ecto' and not numEnvs
+                for backend, tileSize in itertools.product(args.backends if single else ['numpy'],
+                                                            args.tileSize if single else [0]):
+                    case = dict(config)
+                    if backend != 'numpy':
+                        case['backend'] = backend
+                    if tileSize:
+                        if backend != 'numpy':
+                            continue
+                        case['tileSize'] = tileSize
+
+                    key = (kind, numEnvs, tuple(sorted(case.items())))
+                    if key not in seen:
+                        seen.add(key)
+                        yield kind, numEnvs, case
+
+
+def caseName(entry):
+    settings = ','.join('%s=%s' % item for item in sorted(entry['config'].items()))
+    return '%s[numEnvs=%d,%s]' % (entry['env'], entry['numEnvs'], settings)
+
+
+def compare(results, baselinePath):
+    with open(baselinePath) as f:
+        baseline = dict((caseName(entry), entry) for entry in json.load(f)['results'])
+
+    print('\nstep calls/s against %s' % baselinePath)
+    for entry in results:
+        old = baseline.get(caseName(entry))
+        if old is None:
+            continue
+        ratio = entry['step']['calls_per_s'] / old['step']['calls_per_s']
+        print('%6.2fx  %s' % (ratio, caseName(entry)))
+
+
+def flag(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description='Throughput benchmarks of the CTO environments')
+    parser.add_argument('--envs', nargs='+', choices=('cto', 'ecto'), default=['cto', 'ecto'])
+    parser.add_argument('--numEnvs', nargs='+', type=int, default=[0, 16],
+                        help='0 benchmarks the single env, n > 0 a vector env of n episodes')
+    parser.add_argument('--targets', nargs='+', type=int, default=[10, 100])
+    parser.add_argument('--agents', nargs='+', type=int, default=[10])
+    parser.add_argument('--sensorRange', nargs='+', type=float, default=[15])
+    parser.add_argument('--updateRate', nargs='+', type=int, default=[10])
+    parser.add_argument('--compact', nargs='+', type=flag, default=[False])
+    parser.add_argument('--mark', nargs='+', type=flag, default=[False])
+    parser.add_argument('--gridSize', nargs='+', type=float, help='width and height of the arena, 150 by default')
+    parser.add_argument('--tileSize', nargs='+', type=float, default=[0],
+                        help='tile sizes of the single eCtoEnv, 0 runs it without tiles')
+    parser.add_argument('--compactFormat', default='padded')
+    parser.add_argument('--backends', nargs='+', choices=('numpy', 'numba'), default=['numpy'],
+                        help='sub-step backends of the single eCtoEnv, compiled ones are checked against numpy first')
+    parser.add_argument('--paritySteps', type=int, default=50)
+    parser.add_argument('--totalSimTime', type=int, default=1500)
+    parser.add_argument('--initializeCalls', type=int, default=20)
+    parser.add_argument('--resetCalls', type=int, default=20)
+    parser.add_argument('--rewardCalls', type=int, default=200)
+    parser.add_argument('--stepCalls', type=int, default=200)
+    parser.add_argument('--memoryCalls', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='JSON file the results are written to')
+    parser.add_argument('--compare', help='earlier results file to compare the step throughput with')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+
+    results = []
+    for kind, numEnvs, config in cases(args):
+        entry = {'env': kind, 'numEnvs': numEnvs, 'config': config}
+        entry.update(runCase(kind, numEnvs, config, args))
+        results.append(entry)
+
+        step = entry['step']
+        print('%-90s %10.1f steps/s %12.1f sub-steps/s  p50 %8.3fms  p99 %8.3fms  peak %8.1fKiB'
+                % (caseName(entry), step['calls_per_s'], step['sub_steps_per_s'], step['p50_ms'], step['p99_ms'],
+                    step['peak_memory_bytes'] / 1024.0))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({
+                'commit': commitId(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=1)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,72 @@
+import argparse
+import re
+import subprocess
+import sys
+
+"""
+Import time of gym_cto
+
+Imports the package in fresh interpreters with -X importtime and reports the
+cumulative import time of gym_cto and of the slowest modules it pulled in. It
+fails when a module that should only load on demand was imported, pyglet and
+the classic_control viewer load on the first render('human'), Numba on the
+first step of backend='numba', and asyncio and the multiprocessing runners on
+first access to their exports, or when the median import time exceeds
+--budget milliseconds.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --module gym_cto.envs --runs 10 --budget 1500
+"""
+
+#Modules that importing the package must not load. gym itself imports the multiprocessing package, the
+#parallel runner and the sweeps add its shared memory, the server asyncio and concurrent.futures
+DEFERRED = ('pyglet', 'gym.envs.classic_control.rendering', 'numba', 'asyncio', 'concurrent.futures',
+            'multiprocessing.sharedctypes', 'multiprocessing.pool')
+
+#One line of -X importtime output: self and cumulative microseconds, then the indented module name
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+
+# Cumulative import time in microseconds of every top-level and nested module of one import of module
+def importTimes(module):
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stderr=subprocess.PIPE, check=True).stderr.decode()
+    times = {}
+    for match in IMPORT_LINE.finditer(output):
+        times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Import time of gym_cto")
+    parser.add_argument('--module', default='gym_cto', help="module to import")
+    parser.add_argument('--runs', type=int, default=5, help="fresh interpreters to import in")
+    parser.add_argument('--top', type=int, default=10, help="slowest modules to list")
+    parser.add_argument('--budget', type=float, default=None, help="largest median import time in ms")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    runs = [importTimes(args.module) for _ in range(args.runs)]
+    totals = sorted(run[args.module] / 1000.0 for run in runs)
+    median = totals[len(totals) // 2]
+    print("import %s: median %.1f ms, min %.1f ms over %d runs" % (args.module, median, totals[0], len(totals)))
+
+    slowest = sorted(runs[-1].items(), key=lambda item: -item[1])[:args.top]
+    for name, micros in slowest:
+        print("  %8.1f ms  %s" % (micros / 1000.0, name))
+
+    failed = False
+    loaded = [name for name in DEFERRED if name in runs[-1]]
+    if loaded:
+        print("loaded on import: %s" % ', '.join(loaded))
+        failed = True
+    if args.budget is not None and median > args.budget:
+        print("median import time exceeds the budget of %.1f ms" % args.budget)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,26 @@
 # CTO environment
-
+import importlib
 from gym_cto.envs.cto_env import CtoEnv
-from gym_cto.envs.ecto_env import eCtoEnv
\ No newline at end of file
+from gym_cto.envs.ecto_env import eCtoEnv
+from gym_cto.envs.vector_env import VectorCtoEnv, VectorECtoEnv
+
+#Exports whose modules pull in multiprocessing, asyncio or concurrent.futures, imported on first access
+LAZY_EXPORTS = {
+    'ParallelECtoEnv': 'parallel',
+    'TrajectoryRecorder': 'recording',
+    'TrajectoryReplay': 'recording',
+    'EnvServer': 'server',
+    'RemoteEnv': 'server',
+    'SweepRunner': 'sweep',
+    'readResults': 'sweep',
+}
+
+
+def __getattr__(name):
+    if name in LAZY_EXPORTS:
+        return getattr(importlib.import_module('gym_cto.envs.' + LAZY_EXPORTS[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(LAZY_EXPORTS))
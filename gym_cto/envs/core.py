@@ -0,0 +1,168 @@
+import numpy as np
+
+"""
+Batched kinematics shared by the CTO environments
+
+Every function works on arrays of shape (..., 2) so that one call advances all
+entities of an environment at once. Speeds and maximum steps are either shared
+by all entities or per-entity arrays matching the positions.
+"""
+
+# Structure-of-arrays state of count moving entities. Locations, destinations and position increments
+# are (count, 2) views of one contiguous block of the chosen float dtype, stale flags the increments
+# that still have to be calculated and steps counts the sub-steps left on course
+class EntityState(object):
+    __slots__ = ('block', 'locations', 'destinations', 'increments', 'stale', 'steps')
+
+    def __init__(self, count, dtype=np.float64, maxStep=0):
+        self.block = np.zeros((3, count, 2), dtype=dtype)
+        self.locations, self.destinations, self.increments = self.block
+        self.stale = np.ones(count, dtype=bool)
+        self.steps = np.full(count, maxStep, dtype=np.int64)
+
+
+# A setting shared by all count entities stays a scalar, a per-entity one becomes an array of shape (count,)
+def entityParameter(value, count, name, dtype=np.float64):
+    if np.ndim(value) == 0:
+        return value
+    value = np.asarray(value, dtype=dtype)
+    if value.shape != (count,):
+        raise ValueError("%s must be a scalar or hold one value per entity, shape (%d,), got %s"
+                            % (name, count, value.shape))
+    return value
+
+
+# The setting of the entities idx, the value itself when all entities share it
+def perEntity(value, idx):
+    return value[idx] if np.ndim(value) else value
+
+
+# Vectorized calculateIncrements: unit direction from loc to dest scaled by speed
+def calculateIncrements(loc, dest, speed):
+    dx = 1.0*dest[..., 0] - loc[..., 0]
+    dy = 1.0*dest[..., 1] - loc[..., 1]
+
+    theta = np.maximum(np.abs(dx), np.abs(dy))
+    moving = theta != 0.0
+    theta = np.where(moving, theta, 1.0)
+
+    xInc = dx / theta
+    yInc = dy / theta
+    #float_power squares through pow() like the scalar code, plain **2 can differ in the last bit
+    normalizer = np.where(moving, np.sqrt(np.float_power(xInc, 2) + np.float_power(yInc, 2)), 1.0)
+
+    xInc = (xInc / normalizer)*speed
+    yInc = (yInc / normalizer)*speed
+
+    return np.stack((xInc, yInc), axis=-1)
+
+
+# Entities within one unit of their destination along both axes
+def arrived(loc, dest):
+    return np.all(np.abs(dest - loc) < 1, axis=-1)
+
+
+# Targets that have been oncourse for max allowed time or reached their destination
+def rerouteMask(loc, dest, steps):
+    return (steps == 0) | arrived(loc, dest)
+
+
+# Keeps positions inside the arena, in place
+def clampToArena(loc, gridWidth, gridHeight):
+    np.clip(loc[..., 0], 0, gridWidth, out=loc[..., 0])
+    np.clip(loc[..., 1], 0, gridHeight, out=loc[..., 1])
+
+
+# Moves every entity by its increment, calculating the stale increments first
+def advance(loc, increments, stale, dest, speed, gridWidth, gridHeight):
+    if stale.any():
+        increments[stale] = calculateIncrements(loc[stale], dest[stale], perEntity(speed, stale))
+        stale[...] = False
+
+    loc += increments
+    clampToArena(loc, gridWidth, gridHeight)
+
+
+# Positions after each of numSteps moves with fixed increments, shape (numSteps, n, 2).
+# The first move is clamped on its own so a start outside the arena matches the stepwise path
+def straightLine(loc, increments, numSteps, gridWidth, gridHeight):
+    path = np.empty((numSteps,) + loc.shape, dtype=loc.dtype)
+    if numSteps == 0:
+        return path
+
+    path[0] = loc + increments
+    clampToArena(path[0], gridWidth, gridHeight)
+    path[1:] = increments
+
+    #With constant increments an entity that hits a wall stays on it, so clamping the running sum is exact
+    np.cumsum(path, axis=0, out=path)
+    clampToArena(path, gridWidth, gridHeight)
+    return path
+
+
+# Index of the first True along the first axis, numSteps where there is none
+def firstTrue(mask):
+    return np.where(mask.any(axis=0), mask.argmax(axis=0), len(mask))
+
+
+# Trajectories of all targets over numSteps sub-steps, shape (numSteps, numTargets, 2).
+# Every target moves on a straight segment until its next re-route, re-routes are handled
+# in (sub-step, index) order so drawDestinations(count) is called exactly as the stepwise
+# path would. loc, dest, steps, increments and stale are left at their final state
+def targetTrajectories(loc, dest, steps, increments, stale, numSteps, maxStep, speed, gridWidth, gridHeight,
+                        drawDestinations):
+    n = len(loc)
+    path = np.empty((numSteps, n, 2), dtype=loc.dtype)
+    start = loc.copy()
+    segmentStart = np.zeros(n, dtype=np.int64)
+    segmentSteps = steps.copy()
+    nextEvent = np.full(n, numSteps, dtype=np.int64)
+
+    time = 0
+    begin = np.arange(n)
+    reroute = np.flatnonzero(rerouteMask(loc, dest, steps))
+    while True:
+        if len(reroute):
+            dest[reroute] = drawDestinations(len(reroute))
+            segmentSteps[reroute] = perEntity(maxStep, reroute)
+            stale[reroute] = True
+
+        unset = begin[stale[begin]]
+        increments[unset] = calculateIncrements(start[unset], dest[unset], perEntity(speed, unset))
+        stale[unset] = False
+
+        segment = straightLine(start[begin], increments[begin], numSteps - time, gridWidth, gridHeight)
+        path[time:, begin] = segment
+        segmentStart[begin] = time
+
+        #Next re-route: out of steps or arrived, checked at the start of the following sub-step
+        outOfSteps = np.where(segmentSteps[begin] >= 1, segmentSteps[begin], numSteps)
+        arrival = firstTrue(arrived(segment, dest[begin])) + 1
+        nextEvent[begin] = np.minimum(time + np.minimum(outOfSteps, arrival), numSteps)
+
+        time = nextEvent.min() if n else numSteps
+        if time >= numSteps:
+            break
+
+        begin = reroute = np.flatnonzero(nextEvent == time)
+        start[begin] = path[time - 1, begin]
+
+    if numSteps:
+        loc[:] = path[-1]
+    steps[:] = segmentSteps - (numSteps - segmentStart)
+    return path
+
+
+# Trajectories of agents heading for dest over numSteps sub-steps, shape (numSteps, numAgents, 2).
+# Agents snap onto their destination on the sub-step after they arrive. loc is left at the final state
+def agentTrajectories(loc, increments, stale, dest, numSteps, speed, gridWidth, gridHeight):
+    increments[stale] = calculateIncrements(loc[stale], dest[stale], perEntity(speed, stale))
+    stale[...] = False
+
+    path = straightLine(loc, increments, numSteps, gridWidth, gridHeight)
+    reached = np.arange(numSteps)[:, None] > firstTrue(arrived(path, dest))
+    path[reached] = np.broadcast_to(dest, path.shape)[reached]
+
+    if numSteps:
+        loc[:] = path[-1]
+    return path
@@ -1,16 +1,23 @@
 import gym
-import random
 import numpy as np
 from math import sqrt
-from gym.envs.classic_control import rendering
 from gym import logger
+from gym_cto.envs import core
+from gym_cto.envs import seeding
+from gym_cto.envs import spaces
+from gym_cto.envs import placement
+from gym_cto.envs import profiling
+from gym_cto.envs import raster
 
 """
 CTO variant with only 1 observer
 """
 
+#Methods timed when initialize() is called with profile=True
+PROFILED_PHASES = ('step', 'moveTargets', 'moveAgent', 'targetsInRange', 'fastForward', 'restart', 'observe', 'render')
+
 class CtoEnv(gym.Env):
-    metadata = {'render.modes': ['human']}
+    metadata = {'render.modes': ['human', 'rgb_array']}
 
     """
     Summary of the the environment variables
@@ -36,11 +43,25 @@ class CtoEnv(gym.Env):
 
     def __init__(self):
         self.viewer = None
+        self.profiler = None
+        self.recorder = None
+        self.action_space = spaces.actionSpace(single=True)
+        self.observation_space = spaces.ctoObservationSpace()
+        self.seed()
+
+
+    # Seeds the environment's random stream with an int, a SeedSequence or fresh entropy for None.
+    # Takes effect from the next initialize()
+    def seed(self, seed=None):
+        self.np_random, self.seedSequence = seeding.generator(seed)
+        return [self.seedSequence.entropy]
 
 
     def initialize(self, targets=10, sensorRange=15, updateRate=10, targetMaxStep=100,
                     targetSpeed=1.0,
-                    totalSimTime=1500, gridWidth=150, gridHeight=150, compact=False):
+                    totalSimTime=1500, gridWidth=150, gridHeight=150, compact=False,
+                    preallocate=False, macroStep=False, placementRounds=placement.PLACEMENT_ROUNDS,
+                    profile=False, dtype=np.float64, renderEvery=None, newStepApi=False):
         #System variables
         self.curr_episode = 0
         self.curr_step = 0
@@ -70,35 +91,54 @@ class CtoEnv(gym.Env):
 
         self.compactRepresentation = compact
 
-        #Initialize target locations and their destinations
-        self.targetLocations = np.array([[0.0, 0.0]]*self.numTargets)
-        self.targetDestinations = np.array([[0.0, 0.0]]*self.numTargets)
-        self.targetSteps = np.array([self.targetMaxStep]*self.numTargets)
-        self.targetPosIncrements = np.array([(-1000.0, -1000.0)]*self.numTargets)
-
-        for i in xrange(self.numTargets):
-            self.targetDestinations[i][0] = random.uniform(0, self.gridWidth)
-            self.targetDestinations[i][1] = random.uniform(0, self.gridHeight)
-
-            self.targetLocations[i][0] = random.uniform(0, self.gridWidth)
-            self.targetLocations[i][1] = random.uniform(0, self.gridHeight)
-
-            while not self.acceptable(i):
-                self.targetLocations[i][0] = random.uniform(0, self.gridWidth)
-                self.targetLocations[i][1] = random.uniform(0, self.gridHeight)
-
-        #Initialize the agent and ensure it is not on top of other target
-        self.agentPosition = np.array([0.0, 0.0])
-        self.agentPosition[0] = random.uniform(0, self.gridWidth)
-        self.agentPosition[1] = random.uniform(0, self.gridHeight)
-        while not self.acceptable(-1, True):
-            self.agentPosition[0] = random.uniform(0, self.gridWidth)
-            self.agentPosition[1] = random.uniform(0, self.gridHeight)
-
-        self.agentPosIncrements = np.array([-1000.0, -1000.0])
+        #Simulate the whole updateRate window of a step at once instead of sub-step by sub-step
+        self.macroStep = macroStep
+
+        #float32 buffer reused by every observation instead of a fresh array per step
+        self.stateBuffer = None
+        if preallocate and not compact:
+            self.stateBuffer = np.zeros((self.numTargets, 2), dtype=np.float32)
+
+        #Initialize target locations and their destinations, and the agent off the targets
+        #Entities are kept more than one unit apart, placementRounds bounds the batches of redraws
+        #Target positions, destinations and increments are views of one structure-of-arrays store, in
+        #float64 or, to halve their memory, float32. Stale flags mark the increments to calculate
+        self.placementRounds = placementRounds
+        self.dtype = np.dtype(dtype)
+        self.targets = core.EntityState(self.numTargets, self.dtype, self.targetMaxStep)
+        self.targetLocations = self.targets.locations
+        self.targetDestinations = self.targets.destinations
+        self.targetPosIncrements = self.targets.increments
+        self.targetStale = self.targets.stale
+        self.targetSteps = self.targets.steps
+        self.targetDestinations[...], self.targetLocations[...], agent = self.drawLayout()
+
+        self.agentPosition = np.array(agent, dtype=self.dtype)
+        self.agentPosIncrements = np.zeros(2, dtype=self.dtype)
+        self.agentStale = True
+
+        #Pre-generated initial layouts swapped in by reset(), see generateLayouts()
+        self.layouts = None
+
+        #Sub-steps between rendered frames. Set, it also makes step() rasterize those sub-steps into
+        #info['frames'] while no viewer is open
+        self.renderEvery = renderEvery
+        self.renderStride = renderEvery or 1
+        self.rasterizer = None
+        self.stepFrames = []
+
+        #Per-phase timings read through stats(), the plain methods run when profiling is off
+        self.profiler = profiling.instrument(self, PROFILED_PHASES, profile)
 
         self.episodes = self.runTime / self.updateRate  
 
+        #step() returns (obs, reward, terminated, truncated, info) and reset() (obs, info). Episodes only
+        #end by running out of time, so they are truncated and never terminated
+        self.newStepApi = newStepApi
+        self.action_space = spaces.actionSpace(1, self.gridWidth, self.gridHeight, single=True)
+        self.observation_space = spaces.ctoObservationSpace(self.numTargets, self.gridWidth, self.gridHeight,
+                                    compact, self.dtype if compact else np.float32 if preallocate else np.float64)
+
 
     # Checks whether the two points are at least one unit apart
     def acceptable(self, index, agent=False):
@@ -106,7 +146,7 @@ class CtoEnv(gym.Env):
             if index == 0:
                 return True            
             else:
-                for i in xrange(index):
+                for i in range(index):
                     if self.distance(self.targetLocations[index], self.targetLocations[i]) <= 1:
                         return False
                 return True        
@@ -123,74 +163,239 @@ class CtoEnv(gym.Env):
         return sqrt(euclideanDistance)
 
 
-    def reset(self):
-        if self.compactRepresentation:
-            self.state = []
-            for i, t in enumerate(self.targetLocations):
-                if self.distance(self.agentPosition, t) <= self.sensorRange:
-                    self.state.append(t)
+    # Mask of the targets within sensor range of the agent
+    def targetsInRange(self):
+        offset = self.agentPosition - self.targetLocations
+        return np.sqrt(offset[:, 0]**2 + offset[:, 1]**2) <= self.sensorRange
+
+
+    # Destinations, target locations and agent position of a fresh episode
+    def drawLayout(self):
+        destinations = self.randomPoints(self.numTargets)
+        targets = placement.placePoints(self.randomPoints, self.numTargets, self.gridWidth, self.gridHeight,
+                                        maxRounds=self.placementRounds)
+        agent = placement.placePoints(self.randomPoints, 1, self.gridWidth, self.gridHeight,
+                                        avoid=targets, maxRounds=self.placementRounds)[0]
+        return destinations, targets, agent
 
+
+    # Pre-generates count initial layouts that reset() swaps in instead of running placement.
+    # count=0 drops the pool
+    def generateLayouts(self, count):
+        if count == 0:
+            self.layouts = None
+            return
+        self.layouts = tuple(np.stack(part) for part in zip(*[self.drawLayout() for _ in range(count)]))
+
+
+    # Starts a new episode in the existing arrays. The layout is options['layout'] of the pool, a random
+    # pooled layout without that option, or a freshly placed one when there is no pool
+    def restart(self, options=None):
+        options = options or {}
+        if self.layouts is not None:
+            index = options.get('layout')
+            if index is None:
+                index = self.np_random.integers(len(self.layouts[0]))
+            destinations, targets, agent = (part[index] for part in self.layouts)
+        elif options.get('layout') is not None:
+            raise ValueError("There is no layout pool to pick from, call generateLayouts() first")
         else:
-            self.state = [[0.0, 0.0]]*self.numTargets
+            destinations, targets, agent = self.drawLayout()
+
+        self.targetDestinations[...] = destinations
+        self.targetLocations[...] = targets
+        self.targetSteps.fill(self.targetMaxStep)
+        self.targetStale.fill(True)
 
-            for i, t in enumerate(self.targetLocations):
-                if self.distance(self.agentPosition, t) <= self.sensorRange:
-                    self.state[i] = t
+        #step() rebinds the agent position to the action once it arrives, so it gets its own copy
+        self.agentPosition = np.array(agent, dtype=self.dtype)
+        self.agentStale = True
+
+        self.curr_episode = 0
+        self.curr_step = 0
+
+
+    # Returns the first observation of an episode. Right after initialize() that is the initialized
+    # episode, once it has been stepped, or when seed or options are given, a new one is started in place
+    def reset(self, seed=None, options=None, out=None):
+        if seed is not None:
+            self.seed(seed)
+        if seed is not None or options is not None or self.curr_episode > 0:
+            self.restart(options)
+        if self.recorder is not None:
+            self.recorder.recordEpisode(self)
+        obs = self.observe(out)
+        if self.newStepApi:
+            return obs, {}
+        return obs
+
+
+    # Writes the observation into out, the preallocated buffer or a new array, in that order
+    def observe(self, out=None):
+        inRange = self.targetsInRange()
+
+        if self.compactRepresentation:
+            self.state = self.targetLocations[inRange]
+            return self.state
+
+        state = out if out is not None else self.stateBuffer
+        if state is None:
+            state = np.zeros((self.numTargets, 2))
+        else:
+            state.fill(0.0)
+        state[inRange] = self.targetLocations[inRange]
 
         #self.state.append(self.agentPosition)
-        return np.array(self.state)
+        self.state = state
+        return state
 
 
     def step(self, action):
         if self.curr_episode > self.episodes:
-            logger.warn("You are calling 'step()' even though this environment has already returned done = True. You should always call 'initialize()' and 'reset()' once you receive 'done = True'")
+            logger.warn("You are calling 'step()' even though this environment has already returned done = True. You should always call 'reset()' once you receive 'done = True'")
             return
 
-        action = np.array(action).astype('float32')
+        #float32 arrays are used as they are, the step only reads them
+        action = np.asarray(action, dtype=np.float32)
+        if action.shape != (2,):
+            raise ValueError("Incorrect dimensions of action %s. Action must be the destination of the agent"
+                                % (action.shape,))
 
         self.curr_episode += 1
 
         reward = 0
         agentReachedDest = False
-        self.agentPosIncrements = np.array([-1000.0, -1000.0])
+        self.agentStale = True
 
-        for _ in xrange(self.updateRate):
+        self.stepFrames = []
+        if self.macroStep and self.viewer is None:
+            reward = self.fastForward(action)
+            return self.finishStep(action, reward)
+
+        for _ in range(self.updateRate):
             self.curr_step += 1
 
             #Move targets
-            for i in xrange(self.numTargets):
-                self.moveTarget(i)
+            self.moveTargets()
 
             #Move agent
             if not agentReachedDest:
                 agentReachedDest = self.moveAgent(action)
             else:
-                self.agentPosition = action
+                #A copy, moveAgent() moves the position in place and action may be the caller's array
+                self.agentPosition = action.copy()
 
             #Calculate reward at this step
-            for i, t in enumerate(self.targetLocations):
-                if self.distance(self.agentPosition, t) <= self.sensorRange:
-                    reward += 1
+            subReward = int(self.targetsInRange().sum())
+            reward += subReward
+
+            if self.recorder is not None:
+                self.recorder.recordFrames(self.targetLocations, self.agentPosition, subReward)
 
-            if self.viewer is not None:
-                self.render()
+            if (self.viewer is not None or self.renderEvery) and self.curr_step % self.renderStride == 0:
+                self.renderSubStep()
         
-        return self.reset(), reward, self.curr_episode >= self.episodes, {}
+        return self.finishStep(action, reward)
+
+
+    def finishStep(self, action, reward):
+        done = self.curr_episode >= self.episodes
+        if self.recorder is not None:
+            self.recorder.recordStep(action, reward, done)
+
+        obs = self.observe()
+        info = {}
+        if self.stepFrames:
+            info['frames'] = np.stack(self.stepFrames)
+        if self.newStepApi:
+            return obs, reward, False, done, info
+        return obs, reward, done, info
+
+
+    # Draws the current sub-step in the open viewer, or rasterizes it into the frames of the step
+    def renderSubStep(self):
+        if self.viewer is not None:
+            self.render()
+        else:
+            self.stepFrames.append(self.render('rgb_array'))
             
 
+    # Moves everything through the updateRate window from trajectory tensors and returns the reward
+    def fastForward(self, action):
+        targetPath = core.targetTrajectories(self.targetLocations, self.targetDestinations, self.targetSteps,
+                                            self.targetPosIncrements, self.targetStale, self.updateRate,
+                                            self.targetMaxStep, self.targetSpeed, self.gridWidth, self.gridHeight,
+                                            self.randomPoints)
+
+        #The lone agent is cheap to step as usual
+        agentPath = np.empty((self.updateRate, 2))
+        agentReachedDest = False
+        for k in range(self.updateRate):
+            if not agentReachedDest:
+                agentReachedDest = self.moveAgent(action)
+            else:
+                #A copy, moveAgent() moves the position in place and action may be the caller's array
+                self.agentPosition = action.copy()
+            agentPath[k] = self.agentPosition
+
+        self.curr_step += self.updateRate
+
+        offset = agentPath[:, None, :] - targetPath
+        reward = (np.sqrt(offset[..., 0]**2 + offset[..., 1]**2) <= self.sensorRange).sum(axis=1)
+
+        if self.recorder is not None:
+            self.recorder.recordFrames(targetPath, agentPath[:, None, :], reward[:, None])
+
+        #Frames of the rendered sub-steps drawn in one batch
+        if self.renderEvery:
+            rendered = np.flatnonzero((self.curr_step - self.updateRate + np.arange(1, self.updateRate + 1))
+                                        % self.renderStride == 0)
+            self.stepFrames.extend(self.getRasterizer().drawFrames(targetPath[rendered], agentPath[:, None, :][rendered]))
+        return int(reward.sum())
+
+
+    # Call counts and cumulative, mean, last and longest seconds of every profiled phase since
+    # initialize(profile=True) or the last clearStats(). Empty when not profiling
+    def stats(self):
+        return self.profiler.stats() if self.profiler is not None else {}
+
+
+    def clearStats(self):
+        if self.profiler is not None:
+            self.profiler.clear()
+
+
+    # count points drawn uniformly over the arena in one batch, x then y for each point
+    def randomPoints(self, count):
+        return self.np_random.uniform(0.0, (self.gridWidth, self.gridHeight), size=(count, 2))
+
+
+    def moveTargets(self):
+        # Re-route targets that have been oncourse for max allowed time or reached their destination
+        reroute = core.rerouteMask(self.targetLocations, self.targetDestinations, self.targetSteps)
+        if reroute.any():
+            self.targetDestinations[reroute] = self.randomPoints(np.count_nonzero(reroute))
+            self.targetSteps[reroute] = self.targetMaxStep
+            self.targetStale[reroute] = True
+
+        core.advance(self.targetLocations, self.targetPosIncrements, self.targetStale, self.targetDestinations,
+                        self.targetSpeed, self.gridWidth, self.gridHeight)
+        self.targetSteps -= 1
+
+
     def moveTarget(self, idx):
         # Check if this target has been oncourse for max allowed time or it reached its destination
         if self.targetSteps[idx] == 0 or (abs(self.targetDestinations[idx][0] - self.targetLocations[idx][0]) < 1 and 
             abs(self.targetDestinations[idx][1] - self.targetLocations[idx][1]) < 1):
-            self.targetDestinations[idx][0] = random.uniform(0, self.gridWidth)
-            self.targetDestinations[idx][1] = random.uniform(0, self.gridHeight)            
+            self.targetDestinations[idx] = self.randomPoints(1)[0]
             #Create new destination and reset step counter to max allowed time and position increments to default   
             self.targetSteps[idx] = self.targetMaxStep
-            self.targetPosIncrements[idx] = np.array((-1000.0, -1000.0))
+            self.targetStale[idx] = True
 
-        if self.targetPosIncrements[idx][0] == -1000.0 or self.targetPosIncrements[idx][1] == -1000.0:
+        if self.targetStale[idx]:
             self.targetPosIncrements[idx] = self.calculateIncrements(self.targetLocations[idx], 
                                                                         self.targetDestinations[idx], self.targetSpeed)       
+            self.targetStale[idx] = False
 
         self.targetLocations[idx] += self.targetPosIncrements[idx]
 
@@ -207,8 +412,9 @@ class CtoEnv(gym.Env):
 
 
     def moveAgent(self, dest):
-        if self.agentPosIncrements[0] == -1000.0 or self.agentPosIncrements[1] == -1000.0:
+        if self.agentStale:
             self.agentPosIncrements = self.calculateIncrements(self.agentPosition, dest, self.agentSpeed)
+            self.agentStale = False
         
         self.agentPosition += self.agentPosIncrements
 
@@ -253,12 +459,25 @@ class CtoEnv(gym.Env):
         return self.agentPosition
 
 
+    def getRasterizer(self):
+        if self.rasterizer is None:
+            self.rasterizer = raster.Rasterizer(self.gridWidth, self.gridHeight, self.sensorRange)
+        return self.rasterizer
+
+
+    # rgb_array images are rasterized headless, only human mode opens the pyglet viewer
     def render(self, mode='human'):
+        if mode == 'rgb_array':
+            return self.getRasterizer().draw(self.targetLocations, np.reshape(self.agentPosition, (1, 2)))
+
         screen_width = 600
         screen_height = 600
 
         borderOffset = 50.0 #Reduces 50px along 4 sides
 
+        #pyglet and OpenGL only load once something is drawn on screen
+        from gym.envs.classic_control import rendering
+
         if self.viewer is None:
             self.viewer = rendering.Viewer(screen_width, screen_height)
 
@@ -314,7 +533,7 @@ class CtoEnv(gym.Env):
             point = (self.scale[0]*self.agentPosition[0] + borderOffset, self.scale[1]*self.agentPosition[1] + borderOffset)
             self.agent_geom.set_translation(point[0], point[1])
 
-        return self.viewer.render(return_rgb_array = mode=='rgb_array')
+        return self.viewer.render()
 
     def stopRender(self):
         if self.viewer:
@@ -1,24 +1,72 @@
 import gym
-import random
 import numpy as np
 from math import sqrt
-from gym.envs.classic_control import rendering
 from gym import logger
+from gym_cto.envs import core
+from gym_cto.envs import spatial
+from gym_cto.envs import seeding
+from gym_cto.envs import placement
+from gym_cto.envs import profiling
+from gym_cto.envs import raster
+from gym_cto.envs import kernels
+from gym_cto.envs import spaces
 
 """
 CTO variant with only multiple observers
 """
 
+COMPACT_FORMATS = ('list', 'padded', 'csr', 'nearest')
+
+#Compact formats of one fixed shape, which can be preallocated, stacked and shared
+FIXED_FORMATS = ('padded', 'nearest')
+
+#Default skin of the incremental neighbour lists, in sub-steps of target and agent motion
+SKIN_STEPS = 4
+
+#Methods timed when initialize() is called with profile=True
+PROFILED_PHASES = ('step', 'moveTargets', 'moveAgents', 'calculateAgentRewards', 'fastForward', 'compiledStep', 'restart',
+                    'observe', 'render', 'refreshTiles')
+
+#Settings that can be per-entity arrays and change on schedule, and the kind of entity each applies to
+TARGET_SETTINGS = ('targetSpeed', 'targetMaxStep')
+AGENT_SETTINGS = ('agentSpeed', 'sensorRange')
+SETTINGS = TARGET_SETTINGS + AGENT_SETTINGS
+
+#Sub-steps between two selections of the tiles whose targets move, see refreshTiles()
+TILE_REFRESH_STEPS = 16
+
+#Longest stretch of sub-steps a lagging target is caught up on in one batch of trajectories
+CATCH_UP_STEPS = 256
+
+#Due sub-step of the tiles that hold no targets or only ones that keep moving
+NEVER = np.iinfo(np.int64).max
+
 class eCtoEnv(gym.Env):
-    metadata = {'render.modes': ['human']}
+    metadata = {'render.modes': ['human', 'rgb_array']}
 
     def __init__(self):
         self.viewer = None
+        self.profiler = None
+        self.recorder = None
+        self.action_space = spaces.actionSpace()
+        self.observation_space = spaces.ectoObservationSpace()
+        self.seed()
+
+
+    # Seeds the environment's random stream with an int, a SeedSequence or fresh entropy for None.
+    # Takes effect from the next initialize()
+    def seed(self, seed=None):
+        self.np_random, self.seedSequence = seeding.generator(seed)
+        return [self.seedSequence.entropy]
 
 
     def initialize(self, targets=10, agents=10, sensorRange=15, updateRate=10, targetMaxStep=100,
                     targetSpeed=1.0, agentSpeed=1.0,
-                    totalSimTime=1500, gridWidth=150, gridHeight=150, compact=False, mark=False):
+                    totalSimTime=1500, gridWidth=150, gridHeight=150, compact=False, mark=False,
+                    spatialIndex=True, preallocate=False, compactFormat='list', compactSize=None,
+                    macroStep=False, placementRounds=placement.PLACEMENT_ROUNDS, profile=False, incremental=False,
+                    skin=None, dtype=np.float64, renderEvery=None, backend='numpy', newStepApi=False,
+                    tileSize=None, relative=False, obsDtype=None, schedule=None):
         #System variables
         self.curr_episode = 0
         self.curr_step = 0
@@ -33,14 +81,27 @@ class eCtoEnv(gym.Env):
         self.numAgents = agents
 
         #maximum time for which one target can stay oncourse for its destination
-        self.targetMaxStep = targetMaxStep
+        self.targetMaxStep = core.entityParameter(targetMaxStep, self.numTargets, 'targetMaxStep', np.int64)
 
         #speed of target and observer
-        self.targetSpeed = targetSpeed
-        self.agentSpeed = agentSpeed
+        self.targetSpeed = core.entityParameter(targetSpeed, self.numTargets, 'targetSpeed')
+        self.agentSpeed = core.entityParameter(agentSpeed, self.numAgents, 'agentSpeed')
 
         #sensor range of the observer
-        self.sensorRange = sensorRange
+        self.sensorRange = core.entityParameter(sensorRange, self.numAgents, 'sensorRange')
+
+        #schedule maps a number of steps to the SETTINGS, shared scalars or per-entity arrays, that take effect
+        #once the episode has run that many steps. Every episode starts from the initial settings
+        self.initialSettings = dict((name, getattr(self, name)) for name in SETTINGS)
+        self.schedule = dict((int(when), self.parseSettings(settings)) for when, settings in (schedule or {}).items())
+        timeline = [self.initialSettings] + list(self.schedule.values())
+
+        #Range queries reach the largest sensor range, closing speeds and skins follow the fastest entities
+        self.queryRange = max(np.max(settings['sensorRange']) for settings in timeline if 'sensorRange' in settings)
+        self.maxTargetSpeed = max(np.max(settings['targetSpeed']) for settings in timeline if 'targetSpeed' in settings)
+        self.maxAgentSpeed = max(np.max(settings['agentSpeed']) for settings in timeline if 'agentSpeed' in settings)
+        heterogeneous = any(np.ndim(value) for settings in timeline for value in settings.values())
+        agentRanges = any(np.ndim(settings.get('sensorRange')) for settings in timeline)
 
         #time after which observer takes the decision
         self.updateRate = updateRate
@@ -48,41 +109,166 @@ class eCtoEnv(gym.Env):
         self.compactRepresentation = compact
         self.markRewardGivingTargets = mark
 
+        #Simulate the whole updateRate window of a step at once instead of sub-step by sub-step
+        self.macroStep = macroStep
+
+        #'numba' runs the sub-steps of a step in one compiled kernel, see kernels
+        if backend not in kernels.BACKENDS:
+            raise ValueError("backend must be one of %s, got %r" % (', '.join(kernels.BACKENDS), backend))
+        if backend == 'numba' and not kernels.available():
+            logger.warn("Numba is not installed, falling back to the numpy backend")
+            backend = 'numpy'
+        if backend == 'numba' and heterogeneous:
+            raise ValueError("backend='numba' only takes settings shared by all entities")
+        if backend == 'numba' and np.dtype(dtype) not in (np.float32, np.float64):
+            raise ValueError("backend='numba' only takes float32 or float64 positions, got %s" % np.dtype(dtype))
+        self.backend = backend
+
+        #Large arenas are split into tileSize tiles and only the targets of tiles near the agents move
+        #and get queried, see refreshTiles()
+        if tileSize is not None:
+            if tileSize < self.queryRange:
+                raise ValueError("tileSize %s must be at least the sensor range %s" % (tileSize, self.queryRange))
+            if incremental or macroStep or self.backend != 'numpy':
+                raise ValueError("tileSize cannot be combined with incremental, macroStep or the numba backend")
+            #Caught-up targets replay the sub-steps they missed with the current settings
+            if self.schedule:
+                raise ValueError("tileSize cannot be combined with a schedule")
+        self.tileSize = tileSize
+
+        #Layout of compact observations: 'list' of per-agent row arrays, 'padded' (numAgents, compactSize, 3|4)
+        #array with a validity mask, 'csr' flat entity array with per-agent offsets or 'nearest'
+        #(numAgents, 2*compactSize, 3|4) array of the compactSize nearest targets and agents
+        if compactFormat not in COMPACT_FORMATS:
+            raise ValueError("compactFormat must be one of %s, got %r" % (', '.join(COMPACT_FORMATS), compactFormat))
+        if compact and compactFormat == 'nearest' and compactSize is None:
+            raise ValueError("compactFormat='nearest' needs compactSize, the number of nearest targets and agents kept")
+        self.compactFormat = compactFormat
+        self.compactSize = compactSize if compactSize is not None else self.numTargets + self.numAgents - 1
+
+        #Compact rows hold positions relative to the observing agent. Only compact rows have a type
+        #column that tells an entity on top of the agent from an empty row
+        if relative and not compact:
+            raise ValueError("relative coordinates need compact observations")
+        self.relativeCoordinates = relative
+
+        #Buffer reused by every observation instead of a fresh array per step, float32 unless obsDtype is given.
+        #Fresh observation arrays are float64 unless obsDtype is given
+        self.obsDtype = np.dtype(obsDtype).name if obsDtype is not None else None
+        self.stateBuffer = None
+        if preallocate and (not compact or compactFormat in FIXED_FORMATS):
+            self.stateBuffer = np.zeros(self.stateShape(), dtype=self.obsDtype or np.float32)
+        self.observationDtype = self.stateBuffer.dtype if self.stateBuffer is not None \
+                                    else np.dtype(self.obsDtype or np.float64)
+
         #2D field dimensions
         self.gridHeight = gridHeight
         self.gridWidth = gridWidth
 
-        #Initialize target locations and their destinations
-        self.targetLocations = np.array([(0.0, 0.0)]*self.numTargets)
-        self.targetDestinations = np.array([(0.0, 0.0)]*self.numTargets)
-        self.targetSteps = np.array([self.targetMaxStep]*self.numTargets)
-        self.targetPosIncrements = np.array([(-1000.0, -1000.0)]*self.numTargets)
-
-        for i in xrange(self.numTargets):
-            self.targetDestinations[i][0] = random.uniform(0, self.gridWidth)
-            self.targetDestinations[i][1] = random.uniform(0, self.gridHeight)
-
-            self.targetLocations[i][0] = random.uniform(0, self.gridWidth)
-            self.targetLocations[i][1] = random.uniform(0, self.gridHeight)
-
-            while not self.acceptable(i):
-                self.targetLocations[i][0] = random.uniform(0, self.gridWidth)
-                self.targetLocations[i][1] = random.uniform(0, self.gridHeight)
-
-        #Initialize the agents and ensure it is not on top of other target or other agents
-        self.agentLocations = np.array([(0.0, 0.0)]*self.numAgents)
-        self.agentPosIncrements = np.array([(-1000.0, -1000.0)]*self.numAgents)
-
-        for i in xrange(self.numAgents):
-            self.agentLocations[i][0] = random.uniform(0, self.gridWidth)
-            self.agentLocations[i][1] = random.uniform(0, self.gridHeight)
-
-            while not self.acceptable(i, True):
-                self.agentLocations[i][0] = random.uniform(0, self.gridWidth)
-                self.agentLocations[i][1] = random.uniform(0, self.gridHeight)
+        #Grid of cells as wide as the largest sensor range for the agent-target and agent-agent range queries
+        #With tiles the queries only hold nearby entities, so cells are found by binary search rather than
+        #through a lookup table as large as the arena
+        tableSize = 0 if tileSize is not None else spatial.DENSE_TABLE_SIZE
+        self.spatialIndex = spatial.UniformGrid(self.queryRange, self.gridWidth, self.gridHeight, tableSize) \
+                                if spatialIndex else None
+
+        #Candidate pairs within sensorRange + skin that only get re-measured between sub-steps, rebuilt
+        #once the entities have moved skin in total. skin defaults to SKIN_STEPS sub-steps of relative motion
+        self.targetPairs = self.agentPairs = None
+        if incremental:
+            skin = skin if skin is not None else SKIN_STEPS*(self.maxTargetSpeed + self.maxAgentSpeed)
+            self.targetPairs = spatial.NeighbourList(self.queryRange, skin, self.gridWidth, self.gridHeight)
+            self.agentPairs = spatial.NeighbourList(self.queryRange, skin, self.gridWidth, self.gridHeight)
+
+        #Pair queries go through arrays unless both the index and the neighbour lists are off
+        self.batchedQueries = spatialIndex or incremental or tileSize is not None
+        if relative and compactFormat == 'list' and not self.batchedQueries:
+            raise ValueError("relative coordinates need the spatial index or incremental neighbour lists for the "
+                                "'list' format")
+        if agentRanges and not self.batchedQueries:
+            raise ValueError("Per-agent sensor ranges need the spatial index or incremental neighbour lists")
+
+        #In-range pairs and nearest-observer rewards of the current positions, shared by the reward of
+        #the last sub-step and the observation that follows. Every write to the positions drops them
+        self.pairCache = {}
+
+        #Initialize target locations and their destinations, and the agents off the targets and each other
+        #Entities are kept more than one unit apart, placementRounds bounds the batches of redraws
+        #Positions, destinations and increments are views of one structure-of-arrays store per entity kind,
+        #in float64 or, to halve their memory, float32. Stale flags mark the increments to calculate
+        self.placementRounds = placementRounds
+        self.dtype = np.dtype(dtype)
+        self.targets = core.EntityState(self.numTargets, self.dtype, self.targetMaxStep)
+        self.agents = core.EntityState(self.numAgents, self.dtype)
+        self.targetLocations = self.targets.locations
+        self.targetDestinations = self.targets.destinations
+        self.targetPosIncrements = self.targets.increments
+        self.targetStale = self.targets.stale
+        self.targetSteps = self.targets.steps
+        self.agentLocations = self.agents.locations
+        self.agentPosIncrements = self.agents.increments
+        self.agentStale = self.agents.stale
+        self.targetDestinations[...], self.targetLocations[...], self.agentLocations[...] = self.drawLayout()
+
+        #Pre-generated initial layouts swapped in by reset(), see generateLayouts()
+        self.layouts = None
+
+        #Targets of every tile and the sub-step each target was last moved on. The tiles within
+        #sensorRange + tileMargin of the agents are re-selected every TILE_REFRESH_STEPS sub-steps, the margin
+        #covering how far targets and agents can close in on each other in the meantime. Agents snap up to
+        #one unit along each axis onto their destination, so they close in at least sqrt(2) a sub-step
+        self.tileMap = None
+        if tileSize is not None:
+            self.tileMap = spatial.TileMap(tileSize, self.gridWidth, self.gridHeight)
+            self.closingSpeed = self.maxTargetSpeed + max(self.maxAgentSpeed, sqrt(2))
+            self.tileMargin = TILE_REFRESH_STEPS*self.closingSpeed + 1
+            self.resetTiles()
+
+        #Sub-steps between rendered frames. Set, it also makes step() rasterize those sub-steps into
+        #info['frames'] while no viewer is open
+        self.renderEvery = renderEvery
+        self.renderStride = renderEvery or 1
+        self.rasterizer = None
+        self.stepFrames = []
+
+        #Per-phase timings read through stats(), the plain methods run when profiling is off
+        self.profiler = profiling.instrument(self, PROFILED_PHASES, profile)
 
         self.episodes = self.runTime / self.updateRate  
 
+        #step() returns (obs, reward, terminated, truncated, info) and reset() (obs, info). Episodes only
+        #end by running out of time, so they are truncated and never terminated
+        self.newStepApi = newStepApi
+        self.action_space = spaces.actionSpace(self.numAgents, self.gridWidth, self.gridHeight)
+        self.observation_space = spaces.ectoObservationSpace(self.numTargets, self.numAgents, self.gridWidth,
+                                    self.gridHeight, compact, mark, compactFormat, self.compactSize,
+                                    self.observationDtype, self.queryRange if relative else None)
+
+
+    # Scheduled settings checked and converted like the initial ones
+    def parseSettings(self, settings):
+        parsed = {}
+        for name, value in settings.items():
+            if name not in SETTINGS:
+                raise ValueError("Only %s can be scheduled, got %r" % (', '.join(SETTINGS), name))
+            count = self.numTargets if name in TARGET_SETTINGS else self.numAgents
+            parsed[name] = core.entityParameter(value, count, name, np.int64 if name == 'targetMaxStep' else np.float64)
+        return parsed
+
+
+    # Switches to the given settings. Speed changes take effect through fresh increments, a new targetMaxStep
+    # from the next re-route of each target
+    def applySettings(self, settings):
+        for name, value in settings.items():
+            setattr(self, name, value)
+        if 'targetSpeed' in settings:
+            self.targetStale.fill(True)
+        if 'agentSpeed' in settings:
+            self.agentStale.fill(True)
+        if 'sensorRange' in settings:
+            self.rasterizer = None
+            self.invalidatePairs()
+
 
     # Checks whether the two points are at least one unit apart
     def acceptable(self, index, agent=False):
@@ -90,7 +276,7 @@ class eCtoEnv(gym.Env):
             if index == 0:
                 return True            
             else:
-                for i in xrange(index):
+                for i in range(index):
                     if self.distance(self.targetLocations[index], self.targetLocations[i]) <= 1:
                         return False
                 return True        
@@ -99,7 +285,7 @@ class eCtoEnv(gym.Env):
                 if self.distance(self.agentLocations[index], pos) <= 1:
                     return False
             
-            for i in xrange(index):
+            for i in range(index):
                 if self.distance(self.agentLocations[index], self.agentLocations[i]) <= 1:
                     return False
             return True
@@ -111,12 +297,110 @@ class eCtoEnv(gym.Env):
         return sqrt(euclideanDistance)
 
 
-    def reset(self):
+    # Shape of the non-compact or padded compact observation
+    def stateShape(self):
+        if self.compactRepresentation:
+            rows = 2*self.compactSize if self.compactFormat == 'nearest' else self.compactSize
+            return (self.numAgents, rows, 4 if self.markRewardGivingTargets else 3)
+        return (self.numAgents, self.numTargets + self.numAgents, 3 if self.markRewardGivingTargets else 2)
+
+
+    # Destinations, target locations and agent locations of a fresh episode
+    def drawLayout(self):
+        destinations = self.randomPoints(self.numTargets)
+        targets = placement.placePoints(self.randomPoints, self.numTargets, self.gridWidth, self.gridHeight,
+                                        maxRounds=self.placementRounds)
+        agents = placement.placePoints(self.randomPoints, self.numAgents, self.gridWidth, self.gridHeight,
+                                        avoid=targets, maxRounds=self.placementRounds)
+        return destinations, targets, agents
+
+
+    # Pre-generates count initial layouts that reset() swaps in instead of running placement.
+    # count=0 drops the pool
+    def generateLayouts(self, count):
+        if count == 0:
+            self.layouts = None
+            return
+        self.layouts = tuple(np.stack(part) for part in zip(*[self.drawLayout() for _ in range(count)]))
+
+
+    # Starts a new episode in the existing arrays. The layout is options['layout'] of the pool, a random
+    # pooled layout without that option, or a freshly placed one when there is no pool
+    def restart(self, options=None):
+        options = options or {}
+        if self.layouts is not None:
+            index = options.get('layout')
+            if index is None:
+                index = self.np_random.integers(len(self.layouts[0]))
+            destinations, targets, agents = (part[index] for part in self.layouts)
+        elif options.get('layout') is not None:
+            raise ValueError("There is no layout pool to pick from, call generateLayouts() first")
+        else:
+            destinations, targets, agents = self.drawLayout()
+
+        self.targetDestinations[...] = destinations
+        if self.schedule:
+            self.applySettings(self.initialSettings)
+        self.targetLocations[...] = targets
+        self.agentLocations[...] = agents
+        self.targetSteps[...] = self.targetMaxStep
+        self.targetStale.fill(True)
+        self.agentStale.fill(True)
+
+        self.curr_episode = 0
+        self.curr_step = 0
+        if self.tileMap is not None:
+            self.resetTiles()
+        self.invalidatePairs()
+
+
+    # Returns the first observation of an episode. Right after initialize() that is the initialized
+    # episode, once it has been stepped, or when seed or options are given, a new one is started in place
+    def reset(self, seed=None, options=None, out=None):
+        if seed is not None:
+            self.seed(seed)
+        if seed is not None or options is not None or self.curr_episode > 0:
+            self.restart(options)
+        if self.recorder is not None:
+            self.recorder.recordEpisode(self)
+        obs = self.observe(out)
+        if self.newStepApi:
+            return obs, self.stateInfo()
+        return obs
+
+
+    # Writes a non-compact, padded or nearest observation into out, the preallocated buffer or a new array, in that order
+    def observe(self, out=None):
         _, reward_assigned_to = self.calculateAgentRewards()
+        if not self.compactRepresentation and self.batchedQueries:
+            self.state = self.fillState(reward_assigned_to, out)
+            return self.state
+
+        if self.compactRepresentation and self.compactFormat == 'nearest':
+            self.state = self.nearestState(reward_assigned_to, out)
+            return self.state
+
+        if self.compactRepresentation and (self.compactFormat != 'list' or self.batchedQueries):
+            rows, owner = self.compactRows(reward_assigned_to)
+            counts = np.bincount(owner, minlength=self.numAgents)
+
+            if self.compactFormat == 'list':
+                #Agents see different numbers of rows, so the observation is a list of one array per agent
+                self.state = np.split(rows, np.cumsum(counts)[:-1])
+                return self.state
+
+            if self.compactFormat == 'csr':
+                self.stateOffsets = np.concatenate(([0], np.cumsum(counts)))
+                self.state = rows
+                return self.state
+
+            self.state = self.padState(rows, owner, counts, out)
+            return self.state
+
         self.state = []
 
         if self.compactRepresentation:
-            for i in xrange(self.numAgents):
+            for i in range(self.numAgents):
                 agent_state = []
                 for j, t in enumerate(self.targetLocations):
                     if self.distance(self.agentLocations[i], t) <= self.sensorRange:
@@ -128,7 +412,7 @@ class eCtoEnv(gym.Env):
                         else:
                             agent_state.append([t[0], t[1], 1])
 
-                for j in xrange(self.numAgents):
+                for j in range(self.numAgents):
                     if self.distance(self.agentLocations[i], self.agentLocations[j]) <= self.sensorRange and j != i:
                         if self.markRewardGivingTargets:
                             agent_state.append([self.agentLocations[j][0], self.agentLocations[j][1], 2, 0])
@@ -137,7 +421,7 @@ class eCtoEnv(gym.Env):
                 
                 self.state.append(agent_state)            
         else:            
-            for i in xrange(self.numAgents):
+            for i in range(self.numAgents):
                 agent_state = []
                 if self.markRewardGivingTargets:
                     agent_state = [[0.0,0.0,0]]*(self.numTargets + self.numAgents)
@@ -154,7 +438,7 @@ class eCtoEnv(gym.Env):
                         else:
                             agent_state[j] = t
 
-                for j in xrange(self.numAgents):
+                for j in range(self.numAgents):
                     if self.distance(self.agentLocations[i], self.agentLocations[j]) <= self.sensorRange and j != i:
                         if self.markRewardGivingTargets:
                             agent_state[self.numTargets + j] = (self.agentLocations[j][0], self.agentLocations[j][1], 0)
@@ -163,61 +447,293 @@ class eCtoEnv(gym.Env):
                 
                 self.state.append(agent_state)
 
-        return np.array(self.state)
+        if out is not None or self.stateBuffer is not None:
+            state = out if out is not None else self.stateBuffer
+            state[...] = self.state
+            self.state = state
+            return state
+
+        if self.compactRepresentation:
+            width = 4 if self.markRewardGivingTargets else 3
+            self.state = [np.array(agent_state, dtype=self.observationDtype).reshape(-1, width) for agent_state in self.state]
+            return self.state
+        return np.array(self.state, dtype=self.observationDtype)
 
 
     def step(self, action):
         if self.curr_episode > self.episodes:
-            logger.warn("You are calling 'step()' even though this environment has already returned done = True. You should always call 'initialize()' and 'reset()' once you receive 'done = True'")
+            logger.warn("You are calling 'step()' even though this environment has already returned done = True. You should always call 'reset()' once you receive 'done = True'")
             return
 
-        action = np.array(action).astype('float32')
-        
+        #float32 arrays are used as they are, the step only reads them
+        action = np.asarray(action, dtype=np.float32)
         if action.shape != (self.numAgents, 2):
-            logger.error("Incorrect dimenions of action. Action must have destination position for each agent")
-            return
+            raise ValueError("Incorrect dimensions of action %s. Action must have destination position for each agent"
+                                % (action.shape,))
 
+        if self.curr_episode in self.schedule:
+            self.applySettings(self.schedule[self.curr_episode])
         self.curr_episode += 1
 
         reward = np.zeros(self.numAgents)
-        self.agentPosIncrements = np.array([(-1000.0, -1000.0)]*self.numAgents)
-        agentReachedDest = [False]*self.numAgents
-        for _ in xrange(self.updateRate):
+        self.agentStale.fill(True)
+        self.stepFrames = []
+        if self.macroStep and self.viewer is None:
+            reward = self.fastForward(action)
+            return self.finishStep(action, reward)
+
+        #The kernel skips the per sub-step recording and rendering hooks
+        if self.backend == 'numba' and self.viewer is None and self.recorder is None and not self.renderEvery:
+            reward = self.compiledStep(action)
+            return self.finishStep(action, reward)
+
+        agentReachedDest = np.zeros(self.numAgents, dtype=bool)
+        for _ in range(self.updateRate):
             self.curr_step += 1
 
             #Move targets
-            for i in xrange(self.numTargets):
-                self.moveTarget(i)
+            self.moveTargets()
 
             #Move agent
-            for i in xrange(self.numAgents):
-                if not agentReachedDest[i]:
-                    agentReachedDest[i] = self.moveAgent(i, action[i])
-                else: #Already reached. Removes precision errors
-                    self.agentLocations[i] = action[i]
+            self.moveAgents(action, agentReachedDest)
 
             #Calculate reward at this step
-            reward += self.calculateAgentRewards()[0]
+            subReward = self.calculateAgentRewards()[0]
+            reward += subReward
 
-            if self.viewer is not None:
-                self.render()
+            if self.recorder is not None:
+                self.recorder.recordFrames(self.targetLocations, self.agentLocations, subReward)
+
+            if (self.viewer is not None or self.renderEvery) and self.curr_step % self.renderStride == 0:
+                self.renderSubStep()
         
-        return self.reset(), reward, self.curr_episode >= self.episodes, {}
+        return self.finishStep(action, reward)
+
+
+    def finishStep(self, action, reward):
+        done = self.curr_episode >= self.episodes
+        if self.recorder is not None:
+            self.recorder.recordStep(action, reward, done)
+
+        obs = self.observe()
+        info = self.stateInfo()
+        if self.stepFrames:
+            info['frames'] = np.stack(self.stepFrames)
+        if self.newStepApi:
+            return obs, reward, False, done, info
+        return obs, reward, done, info
+
+
+    # Draws the current sub-step in the open viewer, or rasterizes it into the frames of the step
+    def renderSubStep(self):
+        if self.viewer is not None:
+            self.render()
+        else:
+            self.stepFrames.append(self.render('rgb_array'))
             
 
+    # Runs the sub-steps of a step in the compiled kernel and returns the rewards. Destinations are drawn
+    # ahead in blocks of numTargets points and the stream is then moved back to just past the ones used,
+    # so it stays in step with the NumPy path
+    def compiledStep(self, action):
+        reward = np.zeros(self.numAgents)
+        reached = np.zeros(self.numAgents, dtype=bool)
+        bitGenerator = self.np_random.bit_generator
+        subSteps = kernels.compile()
+
+        first = 0
+        while first < self.updateRate:
+            state = bitGenerator.state
+            pool = self.randomPoints(max(self.numTargets, 1))
+            first, used = subSteps(self.targetLocations, self.targetDestinations, self.targetSteps,
+                                            self.targetPosIncrements, self.targetStale, self.agentLocations,
+                                            self.agentPosIncrements, self.agentStale, action, reached, reward, pool,
+                                            first, self.updateRate, self.targetMaxStep, float(self.targetSpeed),
+                                            float(self.agentSpeed), float(self.gridWidth), float(self.gridHeight),
+                                            float(self.sensorRange))
+            #Every coordinate is one 64 bit draw
+            bitGenerator.state = state
+            bitGenerator.advance(2*used)
+
+        self.curr_step += self.updateRate
+        self.invalidatePairs()
+        return reward
+
+
+    # Moves everything through the updateRate window from trajectory tensors and returns the rewards
+    def fastForward(self, action):
+        targetPath = core.targetTrajectories(self.targetLocations, self.targetDestinations, self.targetSteps,
+                                            self.targetPosIncrements, self.targetStale, self.updateRate,
+                                            self.targetMaxStep, self.targetSpeed, self.gridWidth, self.gridHeight,
+                                            self.randomPoints)
+        agentPath = core.agentTrajectories(self.agentLocations, self.agentPosIncrements, self.agentStale, action,
+                                            self.updateRate, self.agentSpeed, self.gridWidth, self.gridHeight)
+        self.curr_step += self.updateRate
+        self.invalidatePairs()
+
+        #Nearest-observer rewards of every sub-step from one grid query grouped by sub-step
+        grid = spatial.UniformGrid(self.queryRange, self.gridWidth, self.gridHeight)
+        pairs = spatial.pairsWithin(grid, targetPath.reshape(-1, 2), agentPath.reshape(-1, 2), self.queryRange,
+                                    np.repeat(np.arange(self.updateRate), self.numTargets),
+                                    np.repeat(np.arange(self.updateRate), self.numAgents))
+        targetIdx, agentIdx, dist = self.observedPairs(pairs, pairs[1] % self.numAgents)
+        reward, _ = spatial.nearestObserver(targetIdx, agentIdx, dist, self.updateRate*self.numTargets,
+                                            self.updateRate*self.numAgents)
+        reward = reward.reshape(self.updateRate, self.numAgents)
+
+        if self.recorder is not None:
+            self.recorder.recordFrames(targetPath, agentPath, reward)
+
+        #Frames of the rendered sub-steps drawn in one batch
+        if self.renderEvery:
+            rendered = np.flatnonzero((self.curr_step - self.updateRate + np.arange(1, self.updateRate + 1))
+                                        % self.renderStride == 0)
+            self.stepFrames.extend(self.getRasterizer().drawFrames(targetPath[rendered], agentPath[rendered]))
+        return reward.sum(axis=0)
+
+
+    # Call counts and cumulative, mean, last and longest seconds of every profiled phase since
+    # initialize(profile=True) or the last clearStats(). Empty when not profiling
+    def stats(self):
+        return self.profiler.stats() if self.profiler is not None else {}
+
+
+    def clearStats(self):
+        if self.profiler is not None:
+            self.profiler.clear()
+
+
+    # count points drawn uniformly over the arena in one batch, x then y for each point
+    def randomPoints(self, count):
+        return self.np_random.uniform(0.0, (self.gridWidth, self.gridHeight), size=(count, 2))
+
+
+    def moveTargets(self):
+        self.invalidatePairs()
+        if self.tileMap is not None:
+            self.moveLiveTargets()
+            return
+
+        # Re-route targets that have been oncourse for max allowed time or reached their destination
+        reroute = core.rerouteMask(self.targetLocations, self.targetDestinations, self.targetSteps)
+        if reroute.any():
+            self.targetDestinations[reroute] = self.randomPoints(np.count_nonzero(reroute))
+            self.targetSteps[reroute] = core.perEntity(self.targetMaxStep, reroute)
+            self.targetStale[reroute] = True
+
+        core.advance(self.targetLocations, self.targetPosIncrements, self.targetStale, self.targetDestinations,
+                        self.targetSpeed, self.gridWidth, self.gridHeight)
+        self.targetSteps -= 1
+
+
+    # Moves the targets of the tiles near the agents, refreshing the selection first when it is due
+    def moveLiveTargets(self):
+        if self.curr_step - 1 >= self.nextRefresh:
+            self.refreshTiles(self.curr_step - 1)
+
+        live = self.liveTargets
+        loc, dest, steps = self.targetLocations[live], self.targetDestinations[live], self.targetSteps[live]
+        increments, stale = self.targetPosIncrements[live], self.targetStale[live]
+
+        reroute = core.rerouteMask(loc, dest, steps)
+        if reroute.any():
+            dest[reroute] = self.randomPoints(np.count_nonzero(reroute))
+            steps[reroute] = core.perEntity(self.targetMaxStep, live[reroute])
+            stale[reroute] = True
+
+        core.advance(loc, increments, stale, dest, core.perEntity(self.targetSpeed, live), self.gridWidth,
+                        self.gridHeight)
+        steps -= 1
+
+        self.targetLocations[live], self.targetDestinations[live], self.targetSteps[live] = loc, dest, steps
+        self.targetPosIncrements[live], self.targetStale[live] = increments, stale
+
+
+    # Buckets the targets of a new episode by tile and schedules every tile
+    def resetTiles(self):
+        self.tileMap.build(self.targetLocations)
+        self.targetClock = np.zeros(self.numTargets, dtype=np.int64)
+        self.tileDue = np.full(self.tileMap.cols*self.tileMap.rows, NEVER, dtype=np.int64)
+        self.liveTargets = np.zeros(0, dtype=np.int64)
+        self.nearTiles = np.zeros(0, dtype=np.int64)
+        self.scheduleTiles(np.array(sorted(self.tileMap.members), dtype=np.int64), 0)
+        self.refreshTiles(0)
+
+
+    # Selects the targets that move and get queried for the next TILE_REFRESH_STEPS sub-steps, once now
+    # sub-steps have run: those of the tiles within sensorRange + tileMargin of an agent. Other targets
+    # stay put, and their tile is due once they could have come into range. Due tiles are caught up on
+    # the sub-steps they missed and scheduled again
+    def refreshTiles(self, now):
+        tiles = self.tileMap
+        previous = self.liveTargets
+        self.targetClock[previous] = now
+        tiles.update(previous, self.targetLocations[previous])
+
+        near = tiles.tilesNear(self.agentLocations, self.queryRange + self.tileMargin)
+        examined = np.union1d(near, np.flatnonzero(self.tileDue < now + TILE_REFRESH_STEPS))
+        waking = tiles.gather(examined)
+        behind = waking[self.targetClock[waking] < now]
+        for clock in np.unique(self.targetClock[behind]):
+            self.catchUp(behind[self.targetClock[behind] == clock], now - clock)
+        self.targetClock[behind] = now
+        tiles.update(behind, self.targetLocations[behind])
+
+        #Examined and formerly near tiles only hold targets that are now current. Tiles that moved
+        #targets entered also hold older ones, so they keep the earlier of the two due times
+        current = np.setdiff1d(np.union1d(examined, self.nearTiles), near)
+        entered = np.setdiff1d(tiles.keys[np.concatenate((previous, behind))], np.union1d(current, near))
+        self.scheduleTiles(current, now)
+        self.scheduleTiles(entered, now, keepEarlier=True)
+        self.tileDue[near] = NEVER
+
+        self.liveTargets = np.sort(tiles.gather(near))
+        self.nearTiles = near
+        self.nextRefresh = now + TILE_REFRESH_STEPS
+
+
+    # Sets the last sub-step on which no target of the tiles, current after now sub-steps, can be in range
+    # of an agent yet, from how fast targets and agents can close in on each other
+    def scheduleTiles(self, keys, now, keepEarlier=False):
+        occupied = np.array([key in self.tileMap.members for key in keys.tolist()], dtype=bool)
+        gap = self.tileMap.distances(keys, self.agentLocations) - self.queryRange
+        safe = occupied & np.isfinite(gap)
+        due = np.full(len(keys), NEVER, dtype=np.int64)
+        due[safe] = now + np.ceil(np.maximum(gap[safe], 0.0) / self.closingSpeed).astype(np.int64) - 1
+        self.tileDue[keys] = np.minimum(self.tileDue[keys], due) if keepEarlier else due
+
+
+    # Moves the targets idx through numSteps sub-steps on their straight segments between re-routes
+    def catchUp(self, idx, numSteps):
+        loc, dest, steps = self.targetLocations[idx], self.targetDestinations[idx], self.targetSteps[idx]
+        increments, stale = self.targetPosIncrements[idx], self.targetStale[idx]
+
+        while numSteps > 0:
+            chunk = min(numSteps, CATCH_UP_STEPS)
+            core.targetTrajectories(loc, dest, steps, increments, stale, chunk, core.perEntity(self.targetMaxStep, idx),
+                                    core.perEntity(self.targetSpeed, idx), self.gridWidth, self.gridHeight,
+                                    self.randomPoints)
+            numSteps -= chunk
+
+        self.targetLocations[idx], self.targetDestinations[idx], self.targetSteps[idx] = loc, dest, steps
+        self.targetPosIncrements[idx], self.targetStale[idx] = increments, stale
+
+
     def moveTarget(self, idx):
+        self.invalidatePairs()
         # Check if this target has been oncourse for max allowed time or it reached its destination
         if self.targetSteps[idx] == 0 or (abs(self.targetDestinations[idx][0] - self.targetLocations[idx][0]) < 1 and 
             abs(self.targetDestinations[idx][1] - self.targetLocations[idx][1]) < 1): #To prevent to & fro movement over destination
-            self.targetDestinations[idx][0] = random.uniform(0, self.gridWidth)
-            self.targetDestinations[idx][1] = random.uniform(0, self.gridHeight)            
+            self.targetDestinations[idx] = self.randomPoints(1)[0]
             #Create new destination and reset step counter to max allowed time and position increments to default   
-            self.targetSteps[idx] = self.targetMaxStep
-            self.targetPosIncrements[idx] = np.array((-1000.0, -1000.0))
+            self.targetSteps[idx] = core.perEntity(self.targetMaxStep, idx)
+            self.targetStale[idx] = True
 
-        if self.targetPosIncrements[idx][0] == -1000.0 or self.targetPosIncrements[idx][1] == -1000.0:
+        if self.targetStale[idx]:
             self.targetPosIncrements[idx] = self.calculateIncrements(self.targetLocations[idx], 
-                                                                        self.targetDestinations[idx], self.targetSpeed)       
+                                                                        self.targetDestinations[idx],
+                                                                        core.perEntity(self.targetSpeed, idx))       
+            self.targetStale[idx] = False
 
         self.targetLocations[idx] += self.targetPosIncrements[idx]
 
@@ -233,9 +749,24 @@ class eCtoEnv(gym.Env):
         self.targetSteps[idx] -= 1
 
 
+    def moveAgents(self, dest, reachedDest):
+        self.invalidatePairs()
+        core.advance(self.agentLocations, self.agentPosIncrements, self.agentStale, dest,
+                        self.agentSpeed, self.gridWidth, self.gridHeight)
+
+        #Already reached. Removes precision errors
+        self.agentLocations[reachedDest] = dest[reachedDest]
+
+        #To prevent to & fro movement over destination
+        reachedDest |= core.arrived(self.agentLocations, dest)
+
+
     def moveAgent(self, index, dest):
-        if self.agentPosIncrements[index][0] == -1000.0 or self.agentPosIncrements[index][1] == -1000.0:
-            self.agentPosIncrements[index] = self.calculateIncrements(self.agentLocations[index], dest, self.agentSpeed)
+        self.invalidatePairs()
+        if self.agentStale[index]:
+            self.agentPosIncrements[index] = self.calculateIncrements(self.agentLocations[index], dest,
+                                                                        core.perEntity(self.agentSpeed, index))
+            self.agentStale[index] = False
 
         self.agentLocations[index] += self.agentPosIncrements[index]
 
@@ -255,7 +786,183 @@ class eCtoEnv(gym.Env):
             return False
 
     
+    # Compact observation rows grouped by agent, targets first and then the other agents, both in index order.
+    # Returns the rows and the agent each row belongs to
+    def compactRows(self, reward_assigned_to):
+        targetIdx, agentIdx, _ = self.targetsInRange()
+        observerIdx, neighbourIdx, _ = self.agentsInRange()
+        width = 4 if self.markRewardGivingTargets else 3
+
+        targetRows = np.zeros((len(targetIdx), width), dtype=self.observationDtype)
+        targetRows[:, :2] = self.rowCoordinates(self.targetLocations[targetIdx], agentIdx)
+        targetRows[:, 2] = 1
+        agentRows = np.zeros((len(neighbourIdx), width), dtype=self.observationDtype)
+        agentRows[:, :2] = self.rowCoordinates(self.agentLocations[neighbourIdx], observerIdx)
+        agentRows[:, 2] = 2
+        if self.markRewardGivingTargets:
+            targetRows[:, 3] = reward_assigned_to[targetIdx] == agentIdx
+
+        rows = np.concatenate((targetRows, agentRows))
+        owner = np.concatenate((agentIdx, observerIdx))
+        entity = np.concatenate((targetIdx, self.numTargets + neighbourIdx))
+        order = np.lexsort((entity, owner))
+
+        return rows[order], owner[order]
+
+
+    # Coordinates of the points in the rows of the agents owner, relative to them with relative=True
+    def rowCoordinates(self, points, owner):
+        if self.relativeCoordinates:
+            return points - self.agentLocations[owner]
+        return points
+
+
+    # Zeroed observation array: out, the preallocated buffer or a new array, in that order
+    def emptyState(self, out=None):
+        state = out if out is not None else self.stateBuffer
+        if state is None:
+            return np.zeros(self.stateShape(), dtype=self.observationDtype)
+        state.fill(0.0)
+        return state
+
+
+    # Pads the compact rows to (numAgents, compactSize, width), dropping the rows past compactSize
+    def padState(self, rows, owner, counts, out=None):
+        state = self.emptyState(out)
+
+        rank = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+        kept = rank < self.compactSize
+        state[owner[kept], rank[kept]] = rows[kept]
+
+        self.stateCounts = np.minimum(counts, self.compactSize)
+        self.stateMask = np.arange(self.compactSize) < self.stateCounts[:, None]
+        return state
+
+
+    # The compactSize nearest targets of every agent in rows [0, compactSize) and its compactSize nearest
+    # other agents in rows [compactSize, 2*compactSize), both nearest first with ties going to the lower
+    # index. Only the in-range pairs are ranked, so the cost and memory follow numAgents*compactSize rather
+    # than numAgents*(numTargets + numAgents)
+    def nearestState(self, reward_assigned_to, out=None):
+        targetIdx, agentIdx, targetDist2 = self.targetsInRange()
+        observerIdx, neighbourIdx, agentDist2 = self.agentsInRange()
+        k = self.compactSize
+        state = self.emptyState(out)
+
+        targetRank, targetCounts = spatial.rankByDistance(agentIdx, targetIdx, targetDist2, self.numAgents)
+        kept = targetRank < k
+        owner, entity, rank = agentIdx[kept], targetIdx[kept], targetRank[kept]
+        state[owner, rank, :2] = self.rowCoordinates(self.targetLocations[entity], owner)
+        state[owner, rank, 2] = 1
+        if self.markRewardGivingTargets:
+            state[owner, rank, 3] = reward_assigned_to[entity] == owner
+
+        agentRank, agentCounts = spatial.rankByDistance(observerIdx, neighbourIdx, agentDist2, self.numAgents)
+        kept = agentRank < k
+        owner, entity, rank = observerIdx[kept], neighbourIdx[kept], k + agentRank[kept]
+        state[owner, rank, :2] = self.rowCoordinates(self.agentLocations[entity], owner)
+        state[owner, rank, 2] = 2
+
+        self.stateCounts = np.minimum(np.stack((targetCounts, agentCounts), axis=1), k)
+        self.stateMask = np.concatenate((np.arange(k) < self.stateCounts[:, :1],
+                                            np.arange(k) < self.stateCounts[:, 1:]), axis=1)
+        return state
+
+
+    # Mask and counts of padded and nearest observations, offsets of csr ones
+    def stateInfo(self):
+        if not self.compactRepresentation or self.compactFormat == 'list':
+            return {}
+        if self.compactFormat == 'csr':
+            return {'offsets': self.stateOffsets}
+        return {'mask': self.stateMask, 'counts': self.stateCounts}
+
+
+    # Non-compact observation filled by masked assignment from the in-range pairs
+    def fillState(self, reward_assigned_to, out=None):
+        targetIdx, agentIdx, _ = self.targetsInRange()
+        observerIdx, neighbourIdx, _ = self.agentsInRange()
+        state = self.emptyState(out)
+
+        state[agentIdx, targetIdx, :2] = self.targetLocations[targetIdx]
+        state[observerIdx, self.numTargets + neighbourIdx, :2] = self.agentLocations[neighbourIdx]
+        if self.markRewardGivingTargets:
+            state[agentIdx, targetIdx, 2] = reward_assigned_to[targetIdx] == agentIdx
+
+        return state
+
+
+    # Drops the pairs and rewards cached for the positions. Whatever writes targetLocations or agentLocations,
+    # or points them at other arrays, calls it before the next reward or observation
+    def invalidatePairs(self):
+        self.pairCache.clear()
+
+
+    # Result of compute() for the current positions, computed on the first call after they changed
+    def cachedPairs(self, name, compute):
+        if name not in self.pairCache:
+            self.pairCache[name] = compute()
+        return self.pairCache[name]
+
+
+    # (target, agent, squared distance) for every target within sensor range of an agent
+    def targetsInRange(self):
+        return self.cachedPairs('targets', self.queryTargets)
+
+
+    # (agent, other agent, squared distance) for every pair of distinct agents within sensor range
+    def agentsInRange(self):
+        return self.cachedPairs('agents', self.queryAgents)
+
+
+    def queryTargets(self):
+        if self.tileMap is not None:
+            targetIdx, agentIdx, dist = self.agentsNear(self.targetLocations[self.liveTargets])
+            pairs = self.liveTargets[targetIdx], agentIdx, dist
+        elif self.targetPairs is not None:
+            pairs = self.targetPairs.query(self.targetLocations, self.agentLocations)
+        else:
+            pairs = self.agentsNear(self.targetLocations)
+        return self.observedPairs(pairs, pairs[1])
+
+
+    def queryAgents(self):
+        if self.agentPairs is not None:
+            observerIdx, neighbourIdx, dist = self.agentPairs.query(self.agentLocations, self.agentLocations)
+        else:
+            observerIdx, neighbourIdx, dist = self.agentsNear(self.agentLocations)
+        distinct = observerIdx != neighbourIdx
+        return self.observedPairs((observerIdx[distinct], neighbourIdx[distinct], dist[distinct]),
+                                    observerIdx[distinct])
+
+
+    # The pairs within the sensor range of their observing agents. Queries reach the largest range of any
+    # agent and any scheduled setting, so the pairs beyond their observer's current range are dropped
+    def observedPairs(self, pairs, observer):
+        if np.ndim(self.sensorRange) == 0 and self.sensorRange >= self.queryRange:
+            return pairs
+        kept = pairs[2] <= core.perEntity(self.sensorRange, observer)**2
+        return tuple(part[kept] for part in pairs)
+
+
+    # (point, agent, squared distance) for every agent within the largest sensor range of the points
+    def agentsNear(self, points):
+        if self.spatialIndex is None:
+            return spatial.densePairs(points, self.agentLocations, self.queryRange)
+
+        return spatial.pairsWithin(self.spatialIndex, points, self.agentLocations, self.queryRange)
+
+
+    # Per-agent rewards and the agent every target is assigned to (-1 if none) for the current positions
     def calculateAgentRewards(self):
+        return self.cachedPairs('rewards', self.nearestObservers)
+
+
+    def nearestObservers(self):
+        if self.batchedQueries:
+            targetIdx, agentIdx, dist = self.targetsInRange()
+            return spatial.nearestObserver(targetIdx, agentIdx, dist, self.numTargets, self.numAgents)
+
         curr_reward = np.zeros(self.numAgents)
         reward_awarded_to = np.zeros(self.numTargets)
 
@@ -304,12 +1011,25 @@ class eCtoEnv(gym.Env):
         return self.agentLocations[i]
 
 
+    def getRasterizer(self):
+        if self.rasterizer is None:
+            self.rasterizer = raster.Rasterizer(self.gridWidth, self.gridHeight, self.sensorRange)
+        return self.rasterizer
+
+
+    # rgb_array images are rasterized headless, only human mode opens the pyglet viewer
     def render(self, mode='human'):
+        if mode == 'rgb_array':
+            return self.getRasterizer().draw(self.targetLocations, self.agentLocations)
+
         screen_width = 600
         screen_height = 600
 
         borderOffset = 50.0 #Reduces 50px along 4 sides
 
+        #pyglet and OpenGL only load once something is drawn on screen
+        from gym.envs.classic_control import rendering
+
         if self.viewer is None:
             self.viewer = rendering.Viewer(screen_width, screen_height)
 
@@ -341,7 +1061,7 @@ class eCtoEnv(gym.Env):
                 self.viewer.add_geom(axle)
 
             self.agents_geom = []
-            for i in self.agentLocations:
+            for index, i in enumerate(self.agentLocations):
                 point = (self.scale[0]*i[0] + borderOffset, self.scale[1]*i[1] + borderOffset)
                 location = rendering.Transform(translation=point)
                 axle = rendering.make_circle(4.0)
@@ -350,7 +1070,8 @@ class eCtoEnv(gym.Env):
                 self.agents_geom.append(location)
                 self.viewer.add_geom(axle)
 
-                coverage = self.viewer.draw_circle(radius=self.scale[0]*self.sensorRange, res=30, filled=False)
+                coverage = self.viewer.draw_circle(radius=self.scale[0]*core.perEntity(self.sensorRange, index), res=30,
+                                                    filled=False)
                 coverage.add_attr(location)
                 coverage.set_color(0.5, 0.5, 0.8)
                 self.viewer.add_geom(coverage)
@@ -368,7 +1089,7 @@ class eCtoEnv(gym.Env):
 
                 a.set_translation(point[0], point[1])
 
-        return self.viewer.render(return_rgb_array = mode=='rgb_array')
+        return self.viewer.render()
 
     def stopRender(self):
         if self.viewer:
@@ -0,0 +1,131 @@
+import importlib.util
+import math
+import numpy as np
+
+"""
+Compiled sub-step kernel of eCtoEnv
+
+One loop moves the targets, moves the agents and hands out the nearest-observer
+rewards of every sub-step of a step, with the arithmetic of the NumPy path in
+core and spatial so both give the same results for a given seed. It is
+compiled with Numba, imported on the first compiled step so that importing the
+environments stays cheap. The environments fall back to the NumPy path when
+Numba is not installed.
+
+The kernel cannot draw from the environment's Generator, so re-routed targets
+take their destinations in order from a block drawn ahead of time. When the
+block runs out the kernel stops before the sub-step that needs more and
+returns how far it got.
+"""
+
+BACKENDS = ('numpy', 'numba')
+
+
+#Functions of the kernel, replaced by their compiled versions once compile() ran
+KERNEL_FUNCTIONS = ('increments', 'advance', 'arrived', 'subSteps')
+
+COMPILED = {}
+
+
+def available():
+    return importlib.util.find_spec('numba') is not None
+
+
+# Compiled subSteps. The helpers are compiled too so the kernel calls them natively
+def compile():
+    if not COMPILED:
+        from numba import njit
+
+        module = globals()
+        for name in KERNEL_FUNCTIONS:
+            COMPILED[name] = module[name] = njit(cache=True)(module[name])
+    return COMPILED['subSteps']
+
+
+# Scalar calculateIncrements of core. The differences stay in the dtype of the positions, like the array
+# version computes them for float32 positions
+def increments(locX, locY, destX, destY, speed):
+    dx = destX - locX
+    dy = destY - locY
+    theta = max(abs(dx), abs(dy))
+    if theta == 0.0:
+        return 0.0, 0.0
+
+    xInc = dx / theta
+    yInc = dy / theta
+    normalizer = math.sqrt(math.pow(xInc, 2.0) + math.pow(yInc, 2.0))
+    return (xInc / normalizer)*speed, (yInc / normalizer)*speed
+
+
+# Moves entity i by its increment, calculating it first when stale, and keeps it inside the arena
+def advance(loc, inc, stale, dest, i, speed, gridWidth, gridHeight):
+    if stale[i]:
+        inc[i, 0], inc[i, 1] = increments(loc[i, 0], loc[i, 1], dest[i, 0], dest[i, 1], speed)
+        stale[i] = False
+
+    loc[i, 0] = min(max(loc[i, 0] + inc[i, 0], 0.0), gridWidth)
+    loc[i, 1] = min(max(loc[i, 1] + inc[i, 1], 0.0), gridHeight)
+
+
+def arrived(loc, dest, i):
+    return abs(dest[i, 0] - loc[i, 0]) < 1 and abs(dest[i, 1] - loc[i, 1]) < 1
+
+
+# Runs sub-steps first to numSteps - 1, adding the rewards of every sub-step to reward. Re-routed
+# targets take their destinations in order from pool. Returns the first sub-step that was not run and
+# the number of pool rows used
+def subSteps(targetLoc, targetDest, targetSteps, targetInc, targetStale, agentLoc, agentInc, agentStale,
+                action, reached, reward, pool, first, numSteps, maxStep, targetSpeed, agentSpeed,
+                gridWidth, gridHeight, sensorRange):
+    numTargets = targetLoc.shape[0]
+    numAgents = agentLoc.shape[0]
+    range2 = sensorRange*sensorRange
+    used = 0
+
+    for k in range(first, numSteps):
+        #Stop before a sub-step whose re-routes the pool cannot cover
+        count = 0
+        for i in range(numTargets):
+            if targetSteps[i] == 0 or arrived(targetLoc, targetDest, i):
+                count += 1
+        if count > pool.shape[0] - used:
+            return k, used
+
+        for i in range(numTargets):
+            if targetSteps[i] == 0 or arrived(targetLoc, targetDest, i):
+                targetDest[i, 0] = pool[used, 0]
+                targetDest[i, 1] = pool[used, 1]
+                used += 1
+                targetSteps[i] = maxStep
+                targetStale[i] = True
+
+            advance(targetLoc, targetInc, targetStale, targetDest, i, targetSpeed, gridWidth, gridHeight)
+            targetSteps[i] -= 1
+
+        for j in range(numAgents):
+            advance(agentLoc, agentInc, agentStale, action, j, agentSpeed, gridWidth, gridHeight)
+
+            #Already reached. Removes precision errors
+            if reached[j]:
+                agentLoc[j, 0] = action[j, 0]
+                agentLoc[j, 1] = action[j, 1]
+            if arrived(agentLoc, action, j):
+                reached[j] = True
+
+        #Nearest observer within range, ties going to the lower index, compared by squared distance like
+        #the range queries of the NumPy path
+        for i in range(numTargets):
+            nearest = -1
+            nearestDist = np.inf
+            for j in range(numAgents):
+                dx = targetLoc[i, 0] - agentLoc[j, 0]
+                dy = targetLoc[i, 1] - agentLoc[j, 1]
+                dist2 = dx*dx + dy*dy
+                if dist2 <= range2 and dist2 < nearestDist:
+                    nearestDist = dist2
+                    nearest = j
+            if nearest != -1:
+                reward[nearest] += 1
+
+    return numSteps, used
+
@@ -0,0 +1,244 @@
+import traceback
+import multiprocessing
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
+from gym import logger
+from gym_cto.envs import seeding
+from gym_cto.envs.ecto_env import FIXED_FORMATS
+
+"""
+Process-pool runner that shards eCtoEnv instances across worker processes
+
+Actions, observations, rewards and dones are exchanged through shared-memory
+NumPy buffers, only short commands travel through the pipes. Every env draws
+from its own child stream of the root seed, and a worker that dies is restarted
+with its envs re-initialized.
+"""
+
+#Shared buffers, in the order they are handed to the workers
+BUFFERS = ('actions', 'observations', 'terminalObservations', 'rewards', 'dones')
+
+
+def sharedArray(shape, dtype):
+    dtype = np.dtype(dtype)
+    raw = RawArray('b', int(np.prod(shape))*dtype.itemsize)
+    return raw, shape, dtype
+
+
+def asArray(buffer):
+    raw, shape, dtype = buffer
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+# SeedSequence of a worker, a distinct child of the root for every (worker, restart) pair
+def workerSeed(root, index, restarts):
+    return np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + (index, restarts))
+
+
+def worker(index, pipe, buffers, config, seed):
+    from gym_cto.envs.ecto_env import eCtoEnv
+
+    #Each worker only touches its own shard of the buffers
+    arrays = dict((name, asArray(b)[index]) for name, b in zip(BUFFERS, buffers))
+    envs = [eCtoEnv() for _ in range(arrays['actions'].shape[0])]
+    for env, child in zip(envs, seeding.spawn(seed, len(envs))):
+        env.seed(child)
+
+    #Envs write their observations straight into shared memory
+    #The runner reads the 4-tuple of step() whatever step API the caller asked for
+    def initialize(e):
+        envs[e].initialize(**dict(config, newStepApi=False))
+        envs[e].stateBuffer = arrays['observations'][e]
+
+    try:
+        for e in range(len(envs)):
+            initialize(e)
+
+        while True:
+            cmd = pipe.recv()
+            if cmd == 'reset':
+                for env in envs:
+                    env.reset()
+                pipe.send(('ok', None))
+
+            #Envs that were just initialized already start an episode
+            elif cmd == 'observe':
+                for env in envs:
+                    env.observe()
+                pipe.send(('ok', None))
+
+            elif cmd == 'step':
+                for e, env in enumerate(envs):
+                    _, reward, done, _ = env.step(arrays['actions'][e])
+                    if done:
+                        arrays['terminalObservations'][e] = arrays['observations'][e]
+                        env.reset()
+                    arrays['rewards'][e] = reward
+                    arrays['dones'][e] = done
+                pipe.send(('ok', None))
+
+            elif cmd == 'close':
+                pipe.close()
+                return
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        pipe.send(('error', traceback.format_exc()))
+
+
+class ParallelECtoEnv(object):
+
+    def __init__(self, numWorkers=None, envsPerWorker=1, seed=None):
+        self.numWorkers = numWorkers or multiprocessing.cpu_count()
+        self.envsPerWorker = envsPerWorker
+        self.numEnvs = self.numWorkers*self.envsPerWorker
+        self.seedSequence = seeding.seedSequence(seed)
+
+        self.processes = [None]*self.numWorkers
+        self.pipes = [None]*self.numWorkers
+        self.restarts = [0]*self.numWorkers
+
+
+    # Takes the same keyword arguments as eCtoEnv.initialize(). Compact observations must use
+    # the padded or nearest format, rows past an agent's count are zero
+    def initialize(self, **kwargs):
+        compact = kwargs.get('compact', False)
+        compactFormat = kwargs.get('compactFormat', 'list')
+        if compact and compactFormat not in FIXED_FORMATS:
+            raise ValueError("Only padded and nearest compact observations have a fixed shape that can be placed "
+                                "in shared memory")
+
+        self.close()
+        self.config = kwargs
+
+        agents = kwargs.get('agents', 10)
+        targets = kwargs.get('targets', 10)
+        mark = kwargs.get('mark', False)
+        shards = (self.numWorkers, self.envsPerWorker)
+        if compact:
+            compactSize = kwargs.get('compactSize') or targets + agents - 1
+            rows = 2*compactSize if compactFormat == 'nearest' else compactSize
+            obsShape = shards + (agents, rows, 4 if mark else 3)
+        else:
+            obsShape = shards + (agents, targets + agents, 3 if mark else 2)
+
+        self.buffers = {
+            'actions': sharedArray(shards + (agents, 2), np.float32),
+            'observations': sharedArray(obsShape, np.float32),
+            'terminalObservations': sharedArray(obsShape, np.float32),
+            'rewards': sharedArray(shards + (agents,), np.float64),
+            'dones': sharedArray(shards, np.bool_),
+        }
+        self.arrays = dict((name, asArray(b)) for name, b in self.buffers.items())
+
+        for w in range(self.numWorkers):
+            self.startWorker(w)
+
+
+    def startWorker(self, w):
+        buffers = [self.buffers[name] for name in BUFFERS]
+
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=worker, args=(w, child, buffers, self.config,
+                                            workerSeed(self.seedSequence, w, self.restarts[w])))
+        process.daemon = True
+        process.start()
+        child.close()
+
+        self.processes[w] = process
+        self.pipes[w] = parent
+
+
+    def restartWorker(self, w):
+        logger.warn("Worker %d died, restarting it and re-initializing its environments" % w)
+        if self.processes[w].is_alive():
+            self.processes[w].terminate()
+        self.processes[w].join()
+        self.restarts[w] += 1
+        self.startWorker(w)
+
+
+    # Sends cmd to every worker and waits for them. Returns the workers that had to be restarted. Every
+    # reply is read before a failure is raised, so none is left in a pipe for the next command
+    def broadcast(self, cmd):
+        restarted = []
+        errors = []
+        for w in range(self.numWorkers):
+            try:
+                self.pipes[w].send(cmd)
+            except (EOFError, OSError):
+                pass
+
+        for w in range(self.numWorkers):
+            try:
+                status, message = self.pipes[w].recv()
+            except (EOFError, OSError):
+                self.restartWorker(w)
+                restarted.append(w)
+                continue
+
+            if status == 'error':
+                errors.append("Worker %d failed:\n%s" % (w, message))
+
+        if errors:
+            raise RuntimeError('\n'.join(errors))
+
+        #Restarted workers start fresh episodes
+        for w in restarted:
+            self.pipes[w].send('observe')
+            status, message = self.pipes[w].recv()
+            if status == 'error':
+                raise RuntimeError("Worker %d failed:\n%s" % (w, message))
+
+        return restarted
+
+
+    def flat(self, name):
+        array = self.arrays[name]
+        return array.reshape((self.numEnvs,) + array.shape[2:])
+
+
+    # Observations are views of the shared buffer, overwritten by the next call
+    def reset(self):
+        self.broadcast('reset')
+        return self.flat('observations')
+
+
+    def step(self, actions):
+        self.flat('actions')[:] = actions
+        restarted = self.broadcast('step')
+
+        dones = self.flat('dones').copy()
+        infos = [{} for _ in range(self.numEnvs)]
+        for i in np.flatnonzero(dones):
+            infos[i]['terminal_observation'] = self.flat('terminalObservations')[i].copy()
+
+        rewards = self.flat('rewards').copy()
+        for w in restarted:
+            shard = slice(w*self.envsPerWorker, (w + 1)*self.envsPerWorker)
+            dones[shard] = True
+            rewards[shard] = 0.0
+            for i in range(shard.start, shard.stop):
+                infos[i] = {'worker_restarted': True}
+
+        return self.flat('observations'), rewards, dones, infos
+
+
+    def close(self):
+        for w, process in enumerate(self.processes):
+            if process is None:
+                continue
+            if process.is_alive():
+                try:
+                    self.pipes[w].send('close')
+                except (EOFError, OSError):
+                    pass
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+            self.processes[w] = None
+            self.pipes[w] = None
+
+
+    def __del__(self):
+        self.close()
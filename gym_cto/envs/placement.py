@@ -0,0 +1,82 @@
+import numpy as np
+from gym_cto.envs import spatial
+
+"""
+Batched initial placement of targets and agents
+
+Candidates for every unplaced entity are drawn in one batch and checked against
+the placed entities and against each other through a uniform grid of
+minDistance sized cells. Only the candidates that collide are redrawn, so
+placement needs a few array passes instead of one distance scan per entity.
+"""
+
+#Default number of batches drawn before giving up on an arena that is too crowded
+PLACEMENT_ROUNDS = 1000
+
+
+# Most points that can be kept more than minDistance apart in the arena, from the density of
+# the hexagonal packing of minDistance wide discs
+def capacity(gridWidth, gridHeight, minDistance=1.0):
+    return int((gridWidth + minDistance)*(gridHeight + minDistance)*2.0/(np.sqrt(3.0)*minDistance**2))
+
+
+# count points that are more than minDistance apart from each other and from the avoid points.
+# randomPoints(k) draws k candidates. Raises ValueError when the points cannot fit in the arena
+# and RuntimeError when they are still colliding after maxRounds batches
+def placePoints(randomPoints, count, gridWidth, gridHeight, avoid=None, minDistance=1.0,
+                maxRounds=PLACEMENT_ROUNDS):
+    avoid = np.zeros((0, 2)) if avoid is None else np.asarray(avoid, dtype=float).reshape(-1, 2)
+
+    limit = capacity(gridWidth, gridHeight, minDistance)
+    if count + len(avoid) > limit:
+        raise ValueError("Cannot place %d entities at least %s apart in a %sx%s arena, it holds at most %d"
+                            % (count + len(avoid), minDistance, gridWidth, gridHeight, limit))
+
+    fixedGrid = spatial.UniformGrid(minDistance, gridWidth, gridHeight)
+    batchGrid = spatial.UniformGrid(minDistance, gridWidth, gridHeight)
+    points = randomPoints(count)
+    pending = np.arange(count)
+
+    #Placed entities live in fixedGrid, the ones placed since it was last built are checked directly
+    fixedGrid.build(avoid)
+    numFixed = len(avoid)
+    recent = np.zeros(0, dtype=np.int64)
+
+    for _ in range(maxRounds):
+        if len(pending) == 0:
+            return points
+
+        candidates = points[pending]
+        rejected = np.zeros(len(pending), dtype=bool)
+
+        #Collisions with the entities that are already placed
+        if numFixed:
+            hits, _, _ = fixedGrid.query(candidates, minDistance)
+            rejected[hits] = True
+        if len(recent):
+            hits, _, _ = spatial.densePairs(candidates, points[recent], minDistance)
+            rejected[hits] = True
+
+        #Collisions inside the batch, the candidate of the later entity is redrawn
+        batchGrid.build(candidates)
+        later, earlier, _ = batchGrid.query(candidates, minDistance)
+        rejected[later[earlier < later]] = True
+
+        recent = np.concatenate((recent, pending[~rejected]))
+        pending = pending[rejected]
+        points[pending] = randomPoints(len(pending))
+
+        #Rebuild once checking the recent entities directly costs more than bucketing everything again
+        if len(recent)*len(pending) > numFixed + len(recent):
+            placed = np.ones(count, dtype=bool)
+            placed[pending] = False
+            fixedGrid.build(np.concatenate((avoid, points[placed])))
+            numFixed = len(avoid) + count - len(pending)
+            recent = recent[:0]
+
+    if len(pending) == 0:
+        return points
+
+    raise RuntimeError("Could not place %d of %d entities at least %s apart in the %sx%s arena within %d rounds, "
+                        "the arena is too crowded" % (len(pending), count, minDistance, gridWidth, gridHeight,
+                                                        maxRounds))
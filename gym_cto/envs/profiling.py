@@ -0,0 +1,74 @@
+from time import perf_counter
+
+"""
+Opt-in per-phase timings of the CTO environments
+
+Profiling replaces the phase methods of one environment instance with timed
+wrappers, so a disabled profiler leaves the class methods untouched and costs
+nothing per step. Phases nest: a step() timing includes the moves, rewards and
+observation it runs.
+"""
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.calls = {}
+        self.total = {}
+        self.last = {}
+        self.longest = {}
+
+
+    # fn wrapped so that every call is recorded under phase
+    def wrap(self, phase, fn):
+        self.calls.setdefault(phase, 0)
+        self.total.setdefault(phase, 0.0)
+        self.last.setdefault(phase, 0.0)
+        self.longest.setdefault(phase, 0.0)
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                self.calls[phase] += 1
+                self.total[phase] += elapsed
+                self.last[phase] = elapsed
+                if elapsed > self.longest[phase]:
+                    self.longest[phase] = elapsed
+
+        timed.__wrapped__ = fn
+        return timed
+
+
+    # Call count, cumulative, mean, last and longest per-call seconds of every phase
+    def stats(self):
+        return dict((phase, {
+            'calls': calls,
+            'total': self.total[phase],
+            'mean': self.total[phase] / calls if calls else 0.0,
+            'last': self.last[phase],
+            'max': self.longest[phase],
+        }) for phase, calls in self.calls.items())
+
+
+    def clear(self):
+        for phase in self.calls:
+            self.calls[phase] = 0
+            self.total[phase] = 0.0
+            self.last[phase] = 0.0
+            self.longest[phase] = 0.0
+
+
+# Times the phases of obj with a new PhaseTimer when enabled, which is returned, and restores the
+# plain methods otherwise
+def instrument(obj, phases, enabled):
+    for phase in phases:
+        obj.__dict__.pop(phase, None)
+    if not enabled:
+        return None
+
+    timer = PhaseTimer()
+    for phase in phases:
+        setattr(obj, phase, timer.wrap(phase, getattr(obj, phase)))
+    return timer
@@ -0,0 +1,94 @@
+import numpy as np
+
+"""
+Headless rasterizer for rgb_array rendering
+
+Draws the same scene as the pyglet viewer, the arena border, targets, agents
+and their sensor circles, straight into uint8 image arrays. Every shape is a
+precomputed stencil of pixel offsets, so all entities of all frames are drawn
+with one fancy-indexed assignment per kind of shape.
+"""
+
+SCREEN_WIDTH = 600
+SCREEN_HEIGHT = 600
+BORDER_OFFSET = 50.0
+
+#Radius in pixels of the target and agent discs
+ENTITY_RADIUS = 4.0
+
+BACKGROUND = (255, 255, 255)
+BORDER_COLOR = (0, 0, 0)
+TARGET_COLOR = (255, 0, 0)
+AGENT_COLOR = (0, 0, 255)
+COVERAGE_COLOR = (127, 127, 204)
+
+
+# (row, col) offsets of the pixels of a disc, or of a one pixel wide circle when ring is set
+def stencil(radius, ring=False):
+    reach = int(np.ceil(radius + 0.5))
+    dy, dx = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+    dist = np.sqrt(dx**2 + dy**2)
+    inside = np.abs(dist - radius) < 0.5 if ring else dist <= radius
+    return dy[inside], dx[inside]
+
+
+class Rasterizer(object):
+
+    def __init__(self, gridWidth, gridHeight, sensorRange, width=SCREEN_WIDTH, height=SCREEN_HEIGHT,
+                    borderOffset=BORDER_OFFSET):
+        self.width = width
+        self.height = height
+        self.borderOffset = borderOffset
+        self.scale = ((width - 2*borderOffset)*1.0/gridWidth, (height - 2*borderOffset)*1.0/gridHeight)
+
+        #One ring per distinct sensor range when agents have ranges of their own
+        self.disc = stencil(ENTITY_RADIUS)
+        self.sensorRange = np.asarray(sensorRange)
+        self.rings = [(radius, stencil(self.scale[0]*radius, ring=True)) for radius in np.unique(self.sensorRange)]
+
+        self.background = np.empty((height, width, 3), dtype=np.uint8)
+        self.background[...] = BACKGROUND
+        low, high = int(round(borderOffset)), int(round(width - borderOffset))
+        top, bottom = self.row(height - borderOffset), self.row(borderOffset)
+        self.background[top:bottom + 1, [low, high]] = BORDER_COLOR
+        self.background[[top, bottom], low:high + 1] = BORDER_COLOR
+
+
+    # Image row of a screen y coordinate, screen y grows upwards like in the viewer
+    def row(self, y):
+        return self.height - 1 - int(round(y))
+
+
+    # Image rows and columns of arena positions
+    def pixels(self, points):
+        cols = np.rint(self.scale[0]*points[..., 0] + self.borderOffset).astype(np.int64)
+        rows = self.height - 1 - np.rint(self.scale[1]*points[..., 1] + self.borderOffset).astype(np.int64)
+        return rows, cols
+
+
+    # Paints the stencil around every position of every frame, positions shaped (numFrames, n, 2)
+    def stamp(self, images, points, shape, color):
+        rows, cols = self.pixels(points)
+        frames = np.broadcast_to(np.arange(len(images))[:, None, None], rows.shape + (1,))
+        rows = rows[..., None] + shape[0]
+        cols = cols[..., None] + shape[1]
+
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        images[np.broadcast_to(frames, rows.shape)[inside], rows[inside], cols[inside]] = color
+
+
+    # (numFrames, height, width, 3) images of the positions of each frame, written into out when given
+    def drawFrames(self, targets, agents, out=None):
+        images = out if out is not None else np.empty((len(targets), self.height, self.width, 3), dtype=np.uint8)
+        images[...] = self.background
+
+        self.stamp(images, targets, self.disc, TARGET_COLOR)
+        for radius, ring in self.rings:
+            ringed = agents if self.sensorRange.ndim == 0 else agents[:, self.sensorRange == radius]
+            self.stamp(images, ringed, ring, COVERAGE_COLOR)
+        self.stamp(images, agents, self.disc, AGENT_COLOR)
+        return images
+
+
+    def draw(self, targets, agents):
+        return self.drawFrames(targets[None], agents[None])[0]
@@ -0,0 +1,223 @@
+import inspect
+import json
+import os
+import numpy as np
+
+"""
+Trajectory recording to append-only binary files and replay from memory maps
+
+A recorder attached to a CtoEnv or eCtoEnv appends the raw bytes of every frame
+to one file per array: the positions at the start of each episode and after
+every sub-step, the reward of every sub-step, and the action, reward and done
+flag of every step. meta.json holds the settings of the env, with its
+schedule, and the shapes and dtypes of the arrays, so the files can be mapped
+back without parsing.
+
+TrajectoryReplay maps the files read-only and reproduces the outputs of step()
+by pointing an env at the recorded positions and building its observation,
+without moving entities or calculating rewards.
+"""
+
+#Settings of the recorded env that replay initializes its own env with
+CONFIG = ('numTargets', 'numAgents', 'sensorRange', 'updateRate', 'targetMaxStep', 'targetSpeed', 'agentSpeed',
+            'runTime', 'gridWidth', 'gridHeight', 'compactRepresentation', 'markRewardGivingTargets',
+            'compactFormat', 'compactSize', 'relativeCoordinates', 'obsDtype')
+
+#initialize() keyword of every setting
+KEYWORDS = {'numTargets': 'targets', 'numAgents': 'agents', 'runTime': 'totalSimTime',
+            'compactRepresentation': 'compact', 'markRewardGivingTargets': 'mark', 'relativeCoordinates': 'relative'}
+
+#Arrays with a row per frame and per step that trajectory() slices
+FRAME_ARRAYS = ('targets', 'agents', 'subRewards')
+STEP_ARRAYS = ('actions', 'rewards', 'dones')
+
+
+# Agent positions of either env as a (numAgents, 2) array
+def agentPoints(env):
+    if hasattr(env, 'agentLocations'):
+        return env.agentLocations
+    return np.reshape(env.agentPosition, (1, 2))
+
+
+class TrajectoryRecorder(object):
+
+    # Starts recording env into the directory path, which must not hold a recording yet
+    def __init__(self, path, env):
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            raise ValueError("%s already holds a recording" % path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.env = env
+        numTargets = env.numTargets
+        numAgents = getattr(env, 'numAgents', 1)
+        dtype = env.targetLocations.dtype.str
+
+        self.layout = {
+            'targets': (dtype, [numTargets, 2]),
+            'agents': (dtype, [numAgents, 2]),
+            'subRewards': ('<f8', [numAgents]),
+            'actions': ('<f4', [numAgents, 2]),
+            'rewards': ('<f8', [numAgents]),
+            'dones': ('|b1', []),
+            'stepFrames': ('<i8', []),
+            'episodeFrames': ('<i8', []),
+            'episodeSteps': ('<i8', []),
+        }
+        #Scheduled settings are recorded as they start every episode, along with the schedule that switches them
+        initial = getattr(env, 'initialSettings', {})
+        config = dict((KEYWORDS.get(name, name), np.asarray(initial.get(name, getattr(env, name))).tolist())
+                        for name in CONFIG if hasattr(env, name))
+        if getattr(env, 'schedule', None):
+            config['schedule'] = dict((str(when), dict((name, np.asarray(value).tolist()) for name, value in settings.items()))
+                                        for when, settings in env.schedule.items())
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'env': type(env).__name__, 'config': config, 'arrays': self.layout}, f, indent=1)
+
+        self.files = dict((name, open(os.path.join(path, name + '.bin'), 'ab')) for name in self.layout)
+        self.frames = 0
+        self.steps = 0
+        env.recorder = self
+
+
+    def write(self, name, array):
+        dtype, _ = self.layout[name]
+        np.ascontiguousarray(array, dtype=dtype).tofile(self.files[name])
+
+
+    # First frame of an episode, called by reset()
+    def recordEpisode(self, env):
+        self.write('episodeFrames', self.frames)
+        self.write('episodeSteps', self.steps)
+        self.recordFrames(env.targetLocations, agentPoints(env), np.zeros(getattr(env, 'numAgents', 1)))
+
+
+    # One or more frames of positions and the rewards collected on them, stacked along the first axis
+    # for more than one
+    def recordFrames(self, targets, agents, subRewards):
+        self.write('targets', targets)
+        self.write('agents', agents)
+        self.write('subRewards', subRewards)
+        self.frames += len(targets) if np.ndim(targets) == 3 else 1
+
+
+    def recordStep(self, action, reward, done):
+        self.write('actions', action)
+        self.write('rewards', reward)
+        self.write('dones', done)
+        self.write('stepFrames', self.frames - 1)
+        self.steps += 1
+
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+
+
+    # Flushes the files and detaches from the env
+    def close(self):
+        if self.env.recorder is self:
+            self.env.recorder = None
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class TrajectoryReplay(object):
+
+    # Maps the recording in path. The env class the recording was made with builds the observations
+    def __init__(self, path):
+        from gym_cto.envs.cto_env import CtoEnv
+        from gym_cto.envs.ecto_env import eCtoEnv
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        self.arrays = {}
+        for name, (dtype, shape) in meta['arrays'].items():
+            filename = os.path.join(path, name + '.bin')
+            dtype = np.dtype(dtype)
+            rows = os.path.getsize(filename) // (dtype.itemsize*int(np.prod(shape)))
+            if rows == 0:
+                self.arrays[name] = np.zeros([0] + shape, dtype=dtype)
+            else:
+                self.arrays[name] = np.memmap(filename, dtype=dtype, mode='r', shape=tuple([rows] + shape))
+
+        self.single = meta['env'] == CtoEnv.__name__
+        self.env = (CtoEnv if self.single else eCtoEnv)()
+        keywords = inspect.signature(type(self.env).initialize).parameters
+        config = dict((k, v) for k, v in meta['config'].items() if k in keywords)
+        self.env.initialize(dtype=self.arrays['targets'].dtype, **config)
+
+        self.schedule = getattr(self.env, 'schedule', {})
+
+        self.numEpisodes = len(self.arrays['episodeFrames'])
+        self.episode = -1
+        self.curr_step = 0
+        self.firstStep = 0
+        self.lastStep = 0
+
+
+    # Zero-copy views of the positions and sub-step rewards of an episode, frame 0 being its start
+    def trajectory(self, episode):
+        frames, steps = self.episodeBounds(episode)
+        return dict([(name, self.arrays[name][frames]) for name in FRAME_ARRAYS] +
+                    [(name, self.arrays[name][steps]) for name in STEP_ARRAYS])
+
+
+    # Frame and step slices of an episode
+    def episodeBounds(self, episode):
+        frameEnd = self.arrays['episodeFrames'][episode + 1] if episode + 1 < self.numEpisodes \
+                    else len(self.arrays['targets'])
+        stepEnd = self.arrays['episodeSteps'][episode + 1] if episode + 1 < self.numEpisodes \
+                    else len(self.arrays['actions'])
+        return (slice(int(self.arrays['episodeFrames'][episode]), int(frameEnd)),
+                slice(int(self.arrays['episodeSteps'][episode]), int(stepEnd)))
+
+
+    # Points the env at the positions of a frame without copying them
+    def showFrame(self, frame):
+        self.env.targetLocations = self.arrays['targets'][frame]
+        if self.single:
+            self.env.agentPosition = self.arrays['agents'][frame, 0]
+        else:
+            self.env.agentLocations = self.arrays['agents'][frame]
+            self.env.invalidatePairs()
+
+
+    # First observation of the next recorded episode, or of the given one
+    def reset(self, episode=None):
+        self.episode = self.episode + 1 if episode is None else episode
+        if self.episode >= self.numEpisodes:
+            raise IndexError("The recording holds %d episodes" % self.numEpisodes)
+
+        frames, steps = self.episodeBounds(self.episode)
+        self.curr_step = steps.start
+        self.firstStep = steps.start
+        self.lastStep = steps.stop
+        if self.schedule:
+            self.env.applySettings(self.env.initialSettings)
+        self.showFrame(frames.start)
+        return self.env.observe()
+
+
+    # Recorded (observation, reward, done, info) of the next step. The action is ignored, the recorded
+    # one is in self.arrays['actions']
+    def step(self, action=None):
+        if self.curr_step >= self.lastStep:
+            raise IndexError("Episode %d has no more recorded steps, call reset()" % self.episode)
+
+        i = self.curr_step
+        self.curr_step += 1
+        #The settings scheduled for this step of the episode were in effect when it was recorded
+        if i - self.firstStep in self.schedule:
+            self.env.applySettings(self.schedule[i - self.firstStep])
+        self.showFrame(self.arrays['stepFrames'][i])
+
+        reward = self.arrays['rewards'][i]
+        if self.single:
+            reward = int(reward[0])
+        obs = self.env.observe()
+        info = self.env.stateInfo() if hasattr(self.env, 'stateInfo') else {}
+        return obs, reward, bool(self.arrays['dones'][i]), info
@@ -0,0 +1,26 @@
+import numpy as np
+
+"""
+Random streams of the CTO environments
+
+Every environment draws from its own numpy Generator. Seeds are turned into
+SeedSequences so batched environments can spawn independent child streams from
+one root seed.
+"""
+
+# SeedSequence of an int seed, of fresh entropy for None, or the given SeedSequence itself
+def seedSequence(seed=None):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+# Generator seeded from seed and the SeedSequence behind it
+def generator(seed=None):
+    sequence = seedSequence(seed)
+    return np.random.Generator(np.random.PCG64(sequence)), sequence
+
+
+# count independent child SeedSequences of seed
+def spawn(seed, count):
+    return seedSequence(seed).spawn(count)
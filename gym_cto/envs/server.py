@@ -0,0 +1,235 @@
+import asyncio
+import json
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from gym_cto.envs import seeding
+from gym_cto.envs.ecto_env import FIXED_FORMATS
+
+"""
+Asyncio server that hosts CtoEnv or eCtoEnv instances behind a Unix socket
+
+Every client connection leases one of the hosted envs and drives it with
+reset and step requests. Requests of all clients are queued, and whatever is
+queued when the simulation thread becomes free runs in one pass, so the event
+loops of the server and the clients never block on the updateRate sub-steps.
+
+Messages are a command or status byte and a payload length followed by the
+payload. Actions, rewards and observations travel as raw float bytes whose
+shapes the server sends as JSON once a client connects.
+"""
+
+#Commands of the clients
+RESET = 1
+STEP = 2
+CLOSE = 3
+
+#Statuses of the server's replies
+OK = 0
+ERROR = 1
+
+HEADER = struct.Struct('<BI')
+
+
+async def readMessage(reader):
+    code, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return code, await reader.readexactly(length)
+
+
+def writeMessage(writer, code, *parts):
+    writer.write(HEADER.pack(code, sum(len(part) for part in parts)))
+    for part in parts:
+        writer.write(part)
+
+
+class EnvServer(object):
+
+    # Hosts numEnvs instances of envClass, each initialized with config and seeded with its own child
+    # stream of seed. Only observations of a fixed shape can be sent, so compact ones must be padded or nearest
+    def __init__(self, envClass, numEnvs, seed=None, **config):
+        if config.get('compact', False) and config.get('compactFormat', 'list') not in FIXED_FORMATS:
+            raise ValueError("Only padded and nearest compact observations have a fixed shape that can be served")
+
+        #The server reads the 4-tuple of step() whatever step API the caller asked for
+        config = dict(config, newStepApi=False)
+        self.envs = [envClass() for _ in range(numEnvs)]
+        for env, child in zip(self.envs, seeding.spawn(seed, numEnvs)):
+            env.seed(child)
+            env.initialize(**config)
+
+        first = self.envs[0]
+        self.spec = {
+            'observationShape': list(np.shape(first.observe())),
+            'actionShape': list(first.action_space.shape),
+            'rewardShape': [first.numAgents] if hasattr(first, 'numAgents') else [],
+        }
+        self.actionBytes = 4*int(np.prod(self.spec['actionShape']))
+
+        self.free = list(range(numEnvs))
+        self.pending = []
+        self.passes = 0
+        self.requests = 0
+
+        #One thread runs every pass, so no env is ever stepped by two threads at once
+        self.executor = ThreadPoolExecutor(1)
+        self.server = None
+        self.batcher = None
+        self.clients = {}
+
+
+    async def start(self, path):
+        self.wakeup = asyncio.Event()
+        self.batcher = asyncio.ensure_future(self.runBatches())
+        self.server = await asyncio.start_unix_server(self.serveClient, path=path)
+
+
+    # Stops listening and disconnects the clients, whose handlers end as if the clients had left
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for writer in self.clients.values():
+            writer.close()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+        if self.batcher is not None:
+            self.batcher.cancel()
+            self.batcher = None
+        self.executor.shutdown()
+
+
+    # Number of passes run and the mean number of requests in a pass
+    def stats(self):
+        return {'passes': self.passes, 'requests': self.requests,
+                'batch': self.requests / self.passes if self.passes else 0.0}
+
+
+    async def serveClient(self, reader, writer):
+        if not self.free:
+            writeMessage(writer, ERROR, ("All %d environments are leased" % len(self.envs)).encode())
+            await writer.drain()
+            writer.close()
+            return
+
+        e = self.free.pop(0)
+        self.clients[asyncio.current_task()] = writer
+        writeMessage(writer, OK, json.dumps(dict(self.spec, env=e)).encode())
+        try:
+            while True:
+                code, payload = await readMessage(reader)
+                if code == CLOSE:
+                    break
+
+                future = asyncio.get_running_loop().create_future()
+                self.pending.append((code, e, payload, future))
+                self.wakeup.set()
+                status, reply = await future
+
+                writeMessage(writer, status, *reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.free.append(e)
+            del self.clients[asyncio.current_task()]
+            writer.close()
+
+
+    # Runs the queued requests in passes. Requests that come in while a pass runs wait for the next one
+    async def runBatches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch, self.pending = self.pending, []
+
+            replies = await loop.run_in_executor(self.executor, self.runPass, batch)
+            self.passes += 1
+            self.requests += len(batch)
+            for (_, _, _, future), reply in zip(batch, replies):
+                if not future.done():
+                    future.set_result(reply)
+
+
+    def runPass(self, batch):
+        replies = []
+        for code, e, payload, _ in batch:
+            try:
+                replies.append((OK, self.handle(code, self.envs[e], payload)))
+            except Exception as error:
+                replies.append((ERROR, [str(error).encode()]))
+        return replies
+
+
+    # Payload parts of the reply to one request
+    def handle(self, code, env, payload):
+        if code == RESET:
+            request = json.loads(payload.decode()) if payload else {}
+            obs = env.reset(seed=request.get('seed'), options=request.get('options'))
+            return [np.ascontiguousarray(obs, dtype=np.float32).tobytes()]
+
+        if code == STEP:
+            if len(payload) != self.actionBytes:
+                raise ValueError("Action must be float32 of shape %s" % (tuple(self.spec['actionShape']),))
+            result = env.step(np.frombuffer(payload, dtype=np.float32).reshape(self.spec['actionShape']))
+            if result is None:
+                raise RuntimeError("The episode is done, call reset()")
+
+            obs, reward, done, _ = result
+            return [np.asarray(reward, dtype=np.float64).tobytes(), bytes([bool(done)]),
+                    np.ascontiguousarray(obs, dtype=np.float32).tobytes()]
+
+        raise ValueError("Unknown command %d" % code)
+
+
+class RemoteEnv(object):
+
+    def __init__(self, reader, writer, spec):
+        self.reader = reader
+        self.writer = writer
+        self.env = spec['env']
+        self.observationShape = tuple(spec['observationShape'])
+        self.actionShape = tuple(spec['actionShape'])
+        self.rewardShape = tuple(spec['rewardShape'])
+        self.rewardBytes = 8*int(np.prod(self.rewardShape))
+
+
+    # Leases an env of the server listening on path. Raises RuntimeError when all of them are leased
+    @classmethod
+    async def connect(cls, path):
+        reader, writer = await asyncio.open_unix_connection(path)
+        status, payload = await readMessage(reader)
+        if status == ERROR:
+            writer.close()
+            raise RuntimeError(payload.decode())
+        return cls(reader, writer, json.loads(payload.decode()))
+
+
+    async def request(self, code, payload=b''):
+        writeMessage(self.writer, code, payload)
+        await self.writer.drain()
+        status, reply = await readMessage(self.reader)
+        if status == ERROR:
+            raise RuntimeError(reply.decode())
+        return reply
+
+
+    # Observations are float32 views of the reply
+    async def reset(self, seed=None, options=None):
+        reply = await self.request(RESET, json.dumps({'seed': seed, 'options': options}).encode())
+        return np.frombuffer(reply, dtype=np.float32).reshape(self.observationShape)
+
+
+    async def step(self, action):
+        reply = await self.request(STEP, np.ascontiguousarray(action, dtype=np.float32).tobytes())
+        reward = np.frombuffer(reply, dtype=np.float64, count=self.rewardBytes // 8).reshape(self.rewardShape)
+        done = bool(reply[self.rewardBytes])
+        obs = np.frombuffer(reply, dtype=np.float32, offset=self.rewardBytes + 1).reshape(self.observationShape)
+        return obs, reward if reward.ndim else reward.item(), done, {}
+
+
+    # Hands the env back to the server
+    async def close(self):
+        writeMessage(self.writer, CLOSE)
+        await self.writer.drain()
+        self.writer.close()
@@ -0,0 +1,77 @@
+import numpy as np
+from gym import spaces
+
+"""
+Action and observation spaces of the CTO environments
+
+Actions are float32 destinations inside the arena. Observation rows are
+(x, y[, type][, mark]) with coordinates inside the arena, type 1 for targets
+and 2 for agents (0 in empty padded rows) and mark 0 or 1, and every row of
+entities out of range is zero. Relative coordinates of compact rows lie within
+the sensor range around the observing agent. Variable length observations, CtoEnv's compact
+one and eCtoEnv's 'list' and 'csr' compact formats, are Sequences of rows that
+also hold them stacked in one (rows, columns) array, the form the envs return.
+
+The defaults are those of initialize(), the envs hold the spaces of the
+default settings until it is called.
+"""
+
+
+# Upper bound of every column of an observation row
+def rowHigh(gridWidth, gridHeight, typed, mark):
+    high = [gridWidth, gridHeight]
+    if typed:
+        high.append(2)
+    if mark:
+        high.append(1)
+    return np.array(high, dtype=np.float64)
+
+
+# Box of shape + (columns,) with the bounds of rowHigh on its last axis. With relativeRange the
+# coordinate columns span [-relativeRange, relativeRange] instead
+def rowBox(shape, high, dtype, relativeRange=None):
+    low = np.zeros_like(high)
+    if relativeRange is not None:
+        low[:2] = -relativeRange
+        high = np.concatenate(([relativeRange, relativeRange], high[2:]))
+    low = np.broadcast_to(low, tuple(shape) + low.shape).astype(dtype)
+    high = np.broadcast_to(high, tuple(shape) + high.shape).astype(dtype)
+    return spaces.Box(low=low, high=high, dtype=dtype)
+
+
+# Sequence of rows that also holds a (rows, columns) array of them
+class RowSequence(spaces.Sequence):
+
+    def contains(self, x):
+        if isinstance(x, np.ndarray) and x.ndim == 2:
+            x = tuple(x)
+        return super().contains(x)
+
+
+# Destination of every agent, (numAgents, 2), or (2,) for the single agent of CtoEnv
+def actionSpace(numAgents=10, gridWidth=150, gridHeight=150, single=False):
+    shape = () if single else (numAgents,)
+    return rowBox(shape, rowHigh(gridWidth, gridHeight, False, False), np.float32)
+
+
+def ctoObservationSpace(targets=10, gridWidth=150, gridHeight=150, compact=False, dtype=np.float64):
+    high = rowHigh(gridWidth, gridHeight, False, False)
+    if compact:
+        return RowSequence(rowBox((), high, dtype))
+    return rowBox((targets,), high, dtype)
+
+
+def ectoObservationSpace(targets=10, agents=10, gridWidth=150, gridHeight=150, compact=False, mark=False,
+                            compactFormat='list', compactSize=None, dtype=np.float64, relativeRange=None):
+    if not compact:
+        return rowBox((agents, targets + agents), rowHigh(gridWidth, gridHeight, False, mark), dtype)
+
+    high = rowHigh(gridWidth, gridHeight, True, mark)
+    compactSize = compactSize if compactSize is not None else targets + agents - 1
+    if compactFormat == 'padded':
+        return rowBox((agents, compactSize), high, dtype, relativeRange)
+    if compactFormat == 'nearest':
+        return rowBox((agents, 2*compactSize), high, dtype, relativeRange)
+    if compactFormat == 'csr':
+        return RowSequence(rowBox((), high, dtype, relativeRange))
+    return spaces.Tuple([RowSequence(rowBox((), high, dtype, relativeRange)) for _ in range(agents)])
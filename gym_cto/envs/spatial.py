@@ -0,0 +1,303 @@
+import numpy as np
+
+"""
+Uniform grid spatial index for fixed-radius neighbour queries
+
+Points are bucketed into square cells at least as wide as the query radius, so
+every neighbour of a query point lies in the 3x3 block of cells around it.
+"""
+
+#Largest number of cells indexed through a lookup table regardless of the point count
+DENSE_TABLE_SIZE = 1 << 20
+
+#Offsets of the 3x3 block of cells around a query cell
+NEIGHBOUR_OFFSETS = np.array([(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+
+
+class UniformGrid(object):
+
+    # Cell starts go through a lookup table while the key space holds at most tableSize cells
+    def __init__(self, cellSize, gridWidth, gridHeight, tableSize=DENSE_TABLE_SIZE):
+        self.cellSize = max(float(cellSize), 1.0)
+        self.tableSize = tableSize
+        self.cols = int(gridWidth // self.cellSize) + 1
+        self.rows = int(gridHeight // self.cellSize) + 1
+
+        self.points = np.zeros((0, 2))
+        self.order = np.zeros(0, dtype=np.int64)
+        self.sortedKeys = np.zeros(0, dtype=np.int64)
+        self.numKeys = 0
+        self.cellStart = None
+
+
+    # Cell coordinates of the points, positions outside the arena fall in the border cells
+    def cellsOf(self, points):
+        cx = np.clip(np.floor(points[:, 0] / self.cellSize), 0, self.cols - 1).astype(np.int64)
+        cy = np.clip(np.floor(points[:, 1] / self.cellSize), 0, self.rows - 1).astype(np.int64)
+        return cx, cy
+
+
+    # Buckets the points by cell. Queries only match points of the same group
+    def build(self, points, groups=None):
+        cx, cy = self.cellsOf(points)
+        keys = cy*self.cols + cx
+        if groups is not None:
+            keys += np.asarray(groups, dtype=np.int64)*(self.rows*self.cols)
+
+        self.points = points
+        self.order = np.argsort(keys, kind='stable')
+        self.sortedKeys = keys[self.order]
+
+        #Direct lookup table of cell starts when the key space is small enough, binary search otherwise
+        self.numKeys = int(keys.max()) + 1 if len(keys) else 0
+        self.cellStart = None
+        if self.numKeys <= max(self.tableSize, 4*len(keys)):
+            self.cellStart = np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=self.numKeys))))
+
+
+    # Returns (query index, point index, squared distance) for every pair within radius
+    def query(self, queries, radius, groups=None):
+        if radius > self.cellSize:
+            raise ValueError("Query radius %s exceeds the cell size %s of the grid" % (radius, self.cellSize))
+
+        cx, cy = self.cellsOf(queries)
+        nx = cx[:, None] + NEIGHBOUR_OFFSETS[:, 0]
+        ny = cy[:, None] + NEIGHBOUR_OFFSETS[:, 1]
+        inside = (nx >= 0) & (nx < self.cols) & (ny >= 0) & (ny < self.rows)
+
+        keys = ny*self.cols + nx
+        if groups is not None:
+            keys += np.asarray(groups, dtype=np.int64)[:, None]*(self.rows*self.cols)
+
+        if self.cellStart is not None:
+            inside &= keys < self.numKeys
+            keys = np.where(inside, keys, 0)
+            start = self.cellStart[keys]
+            end = self.cellStart[keys + 1]
+        else:
+            start = np.searchsorted(self.sortedKeys, keys, side='left')
+            end = np.searchsorted(self.sortedKeys, keys, side='right')
+        counts = np.where(inside, end - start, 0).ravel()
+
+        #Expand every (query, cell) bucket into its candidate pairs
+        total = counts.sum()
+        qIdx = np.repeat(np.repeat(np.arange(len(queries)), len(NEIGHBOUR_OFFSETS)), counts)
+        firsts = np.repeat(start.ravel() - np.cumsum(counts) + counts, counts)
+        pIdx = self.order[firsts + np.arange(total)]
+
+        dist2 = squaredDistances(queries[qIdx], self.points[pIdx])
+        inRange = dist2 <= radius*radius
+
+        return qIdx[inRange], pIdx[inRange], dist2[inRange]
+
+
+# Pairs within radius kept up to date from a list of candidate pairs within radius + skin.
+# While the queries and points have moved less than skin in total since the list was built no
+# pair outside it can have crossed into range, so a query only measures the candidates and the
+# grid is rebuilt once per skin worth of motion instead of on every query
+class NeighbourList(object):
+
+    def __init__(self, radius, skin, gridWidth, gridHeight):
+        self.radius = radius
+        self.skin = skin
+        self.grid = UniformGrid(radius + skin, gridWidth, gridHeight)
+        self.queryRef = None
+        self.pointRef = None
+        self.rebuilds = 0
+
+
+    # Largest distance moved by any of the points since ref
+    @staticmethod
+    def drift(points, ref):
+        if len(points) == 0:
+            return 0.0
+        return pairDistances(points, ref).max()
+
+
+    def stale(self, queries, points):
+        if self.queryRef is None or self.queryRef.shape != queries.shape or self.pointRef.shape != points.shape:
+            return True
+        return self.drift(queries, self.queryRef) + self.drift(points, self.pointRef) > self.skin
+
+
+    def build(self, queries, points):
+        self.qIdx, self.pIdx, _ = pairsWithin(self.grid, queries, points, self.radius + self.skin)
+        self.queryRef = queries.copy()
+        self.pointRef = points.copy()
+        self.rebuilds += 1
+
+
+    # Returns (query index, point index, squared distance) for every pair within radius, like pairsWithin
+    def query(self, queries, points):
+        if self.stale(queries, points):
+            self.build(queries, points)
+
+        dist2 = squaredDistances(queries[self.qIdx], points[self.pIdx])
+        inRange = dist2 <= self.radius*self.radius
+        return self.qIdx[inRange], self.pIdx[inRange], dist2[inRange]
+
+
+# Entities bucketed by square tiles of the arena. Every occupied tile keeps the indices of its
+# entities, and update() only moves the entities given to it between tiles, so the entities of a
+# region can be gathered without touching the rest of the arena
+class TileMap(object):
+
+    def __init__(self, tileSize, gridWidth, gridHeight):
+        self.tileSize = float(tileSize)
+        self.cols = int(gridWidth // self.tileSize) + 1
+        self.rows = int(gridHeight // self.tileSize) + 1
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.leaving = np.zeros(0, dtype=bool)
+        self.members = {}
+
+
+    # Tile of every point, positions outside the arena fall in the border tiles
+    def tilesOf(self, points):
+        cx = np.clip(np.floor(points[:, 0] / self.tileSize), 0, self.cols - 1).astype(np.int64)
+        cy = np.clip(np.floor(points[:, 1] / self.tileSize), 0, self.rows - 1).astype(np.int64)
+        return cy*self.cols + cx
+
+
+    def build(self, points):
+        self.keys = self.tilesOf(points)
+        self.leaving = np.zeros(len(points), dtype=bool)
+        self.members = {}
+        self.add(np.arange(len(points)), self.keys)
+
+
+    # Appends the entities idx to the tiles keys
+    def add(self, idx, keys):
+        if len(keys) == 0:
+            return
+        order = np.argsort(keys, kind='stable')
+        idx, keys = idx[order], keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(keys)]):
+            key = int(keys[start])
+            members = self.members.get(key)
+            self.members[key] = idx[start:end] if members is None else np.concatenate((members, idx[start:end]))
+
+
+    # Moves the entities idx, now at points, to the tiles they are in
+    def update(self, idx, points):
+        keys = self.tilesOf(points)
+        moved = keys != self.keys[idx]
+        if not moved.any():
+            return
+
+        idx, keys = idx[moved], keys[moved]
+        self.leaving[idx] = True
+        for key in np.unique(self.keys[idx]).tolist():
+            members = self.members[key]
+            members = members[~self.leaving[members]]
+            if len(members):
+                self.members[key] = members
+            else:
+                del self.members[key]
+        self.leaving[idx] = False
+
+        self.keys[idx] = keys
+        self.add(idx, keys)
+
+
+    # Keys of the tiles overlapping the squares of half width reach around the points
+    def tilesNear(self, points, reach):
+        if len(points) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        low = np.clip(np.floor((points - reach) / self.tileSize), 0, (self.cols - 1, self.rows - 1)).astype(np.int64)
+        high = np.clip(np.floor((points + reach) / self.tileSize), 0, (self.cols - 1, self.rows - 1)).astype(np.int64)
+        span = (high - low).max(axis=0) + 1
+        dx, dy = np.meshgrid(np.arange(span[0]), np.arange(span[1]))
+        cx = low[:, 0, None] + dx.ravel()
+        cy = low[:, 1, None] + dy.ravel()
+        inside = (cx <= high[:, 0, None]) & (cy <= high[:, 1, None])
+        return np.unique((cy*self.cols + cx)[inside])
+
+
+    # Distance from every tile of keys to the nearest of the points, inf without points
+    def distances(self, keys, points):
+        if len(points) == 0:
+            return np.full(len(keys), np.inf)
+
+        #Per axis the gap is how far the point lies outside the tile's extent around its center
+        half = 0.5*self.tileSize
+        gapX = np.abs(((keys % self.cols)*self.tileSize + half)[:, None] - points[:, 0]) - half
+        gapY = np.abs(((keys // self.cols)*self.tileSize + half)[:, None] - points[:, 1]) - half
+        np.maximum(gapX, 0.0, out=gapX)
+        np.maximum(gapY, 0.0, out=gapY)
+        gapX *= gapX
+        gapY *= gapY
+        gapX += gapY
+        return np.sqrt(gapX.min(axis=1, initial=np.inf))
+
+
+    # Indices of the entities in the tiles keys, in no particular order
+    def gather(self, keys):
+        found = [self.members[key] for key in keys.tolist() if key in self.members]
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+
+# (query index, point index, squared distance) for every pair within radius. The larger of the two sets is
+# bucketed since expanding few queries over full cells is cheaper than many queries over sparse ones
+def pairsWithin(grid, queries, points, radius, queryGroups=None, pointGroups=None):
+    if len(points) >= len(queries):
+        grid.build(points, pointGroups)
+        return grid.query(queries, radius, queryGroups)
+
+    grid.build(queries, queryGroups)
+    pIdx, qIdx, dist2 = grid.query(points, radius, pointGroups)
+    return qIdx, pIdx, dist2
+
+
+# Brute-force counterpart of UniformGrid.query, comparing every query with every point
+def densePairs(queries, points, radius):
+    offset = points[None, :, :] - queries[:, None, :]
+    dist2 = offset[..., 0]**2 + offset[..., 1]**2
+    qIdx, pIdx = np.nonzero(dist2 <= radius*radius)
+    return qIdx, pIdx, dist2[qIdx, pIdx]
+
+
+# Squared euclidean distance between matching rows. Range tests compare it with the squared radius
+# and nearest observers only need its order, so neither takes a square root
+def squaredDistances(pos1, pos2):
+    return (pos1[:, 0] - pos2[:, 0])**2 + (pos1[:, 1] - pos2[:, 1])**2
+
+
+# Euclidean distance between matching rows, same arithmetic as the envs' distance()
+def pairDistances(pos1, pos2):
+    return np.sqrt(squaredDistances(pos1, pos2))
+
+
+# Rank of every pair among the pairs of its query, nearest first with ties going to the lower point index,
+# and the number of pairs of every query. Ranks below k select the k nearest points of every query
+def rankByDistance(qIdx, pIdx, dist2, numQueries):
+    order = np.lexsort((pIdx, dist2, qIdx))
+    counts = np.bincount(qIdx, minlength=numQueries)
+    rank = np.empty(len(qIdx), dtype=np.int64)
+    rank[order] = np.arange(len(qIdx)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rank, counts
+
+
+# For each target the closest observer among the in-range pairs, ties going to the lower index. dist may
+# hold distances or the squared distances of the range queries, only their order matters. Returns the per-agent reward counts and the observer assigned to every target (-1 if none)
+def nearestObserver(targetIdx, agentIdx, dist, numTargets, numAgents):
+    reward = np.zeros(numAgents)
+    assignedTo = np.full(numTargets, -1.0)
+    if len(targetIdx) == 0:
+        return reward, assignedTo
+
+    #Group the pairs by target, queries already return them grouped
+    if np.any(targetIdx[1:] < targetIdx[:-1]):
+        order = np.argsort(targetIdx, kind='stable')
+        targetIdx, agentIdx, dist = targetIdx[order], agentIdx[order], dist[order]
+
+    starts = np.flatnonzero(np.r_[True, targetIdx[1:] != targetIdx[:-1]])
+    sizes = np.diff(np.r_[starts, len(targetIdx)])
+    nearest = np.repeat(np.minimum.reduceat(dist, starts), sizes)
+    chosen = np.minimum.reduceat(np.where(dist == nearest, agentIdx, numAgents), starts)
+
+    reward += np.bincount(chosen, minlength=numAgents)
+    assignedTo[targetIdx[starts]] = chosen
+
+    return reward, assignedTo
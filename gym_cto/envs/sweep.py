@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import inspect
+import itertools
+import multiprocessing
+import numpy as np
+from gym_cto.envs import seeding
+from gym_cto.envs.ecto_env import eCtoEnv
+
+"""
+Parameter sweeps of eCtoEnv episodes run in parallel into columnar result files
+
+Every cell of the grid, a combination of initialize() settings, runs the same
+number of episodes under a fixed policy. Cells that only differ in settings
+that do not affect placement, such as sensorRange or updateRate, share one pool
+of initial layouts, so episode i of each of them starts from the same layout.
+Layout i of a pool is placed from its own seed stream, so a chunk only places
+the layouts of its own episodes, and a worker keeps them for the chunks of the
+other cells of the pool it runs next.
+
+Episodes run in chunks spread over a process pool. Each finished chunk appends
+one row per episode to one binary file per column, and then its entry to a
+checkpoint file. A sweep that is run again on the same directory truncates the
+columns to the last checkpoint and only runs the chunks missing from it.
+"""
+
+#initialize() settings that decide the initial layouts, cells that agree on them share a layout pool
+LAYOUT_SETTINGS = ('targets', 'agents', 'gridWidth', 'gridHeight', 'placementRounds', 'dtype')
+
+#Metric columns of every episode, after a column per grid setting
+COLUMNS = (('cell', '<i8'), ('episode', '<i8'), ('totalReward', '<f8'), ('coverage', '<f8'), ('steps', '<i8'),
+            ('seconds', '<f8'), ('stepsPerSec', '<f8'))
+
+#Spawn keys of the layout pools and the episode chunks, kept apart under the root seed
+LAYOUT_STREAM = 0
+EPISODE_STREAM = 1
+
+#Layouts placed so far for the last layout group and env of the last cell, per worker process
+LAYOUTS = {}
+CURRENT = {}
+
+
+# Heads every agent for its nearest target
+def greedyPolicy(env):
+    offset = env.targetLocations[None, :, :] - env.agentLocations[:, None, :]
+    nearest = np.argmin(offset[..., 0]**2 + offset[..., 1]**2, axis=1)
+    return env.targetLocations[nearest]
+
+
+# Value of every layout setting in the settings of a cell, defaults of initialize() for the missing ones
+def layoutKey(settings):
+    defaults = inspect.signature(eCtoEnv.initialize).parameters
+    return tuple(str(settings.get(name, defaults[name].default)) for name in LAYOUT_SETTINGS)
+
+
+# Layouts first to first + count of group, stacked like generateLayouts() does. Each is placed once per
+# worker, from its own child stream of the root seed. Chunks come ordered by group, so a worker only keeps
+# the layouts of the last one
+def layoutPool(settings, group, root, first, count):
+    if LAYOUTS.get('group') != group:
+        LAYOUTS.clear()
+        LAYOUTS['group'] = group
+        LAYOUTS['env'] = eCtoEnv()
+        LAYOUTS['env'].initialize(**dict((name, settings[name]) for name in LAYOUT_SETTINGS if name in settings))
+        LAYOUTS['placed'] = {}
+
+    env, placed = LAYOUTS['env'], LAYOUTS['placed']
+    for i in range(first, first + count):
+        if i not in placed:
+            env.seed(np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + (LAYOUT_STREAM, group, i)))
+            placed[i] = env.drawLayout()
+    return tuple(np.stack(part) for part in zip(*[placed[i] for i in range(first, first + count)]))
+
+
+# Runs count episodes of a cell from episode first on and returns their metric columns. Episode i starts
+# from layout i of the pool, and each chunk draws from its own child stream of the root seed
+def runChunk(task):
+    cell, chunk, first, count, settings, group, root, policy = task
+
+    if CURRENT.get('cell') != cell:
+        CURRENT['env'] = eCtoEnv()
+        CURRENT['env'].initialize(**dict(settings, newStepApi=False))
+        CURRENT['cell'] = cell
+    env = CURRENT['env']
+    env.layouts = layoutPool(settings, group, root, first, count)
+    env.seed(np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + (EPISODE_STREAM, cell, chunk)))
+
+    columns = dict((name, np.zeros(count, dtype=dtype)) for name, dtype in COLUMNS)
+    for i in range(count):
+        start = time.perf_counter()
+        env.reset(options={'layout': i})
+        total, steps, done = 0.0, 0, False
+        while not done:
+            _, reward, done, _ = env.step(policy(env))
+            total += reward.sum()
+            steps += 1
+        seconds = time.perf_counter() - start
+
+        columns['episode'][i] = first + i
+        columns['totalReward'][i] = total
+        #Every target observed on a sub-step rewards exactly one agent
+        columns['coverage'][i] = total / max(env.numTargets*steps*env.updateRate, 1)
+        columns['steps'][i] = steps
+        columns['seconds'][i] = seconds
+        columns['stepsPerSec'][i] = steps / seconds if seconds > 0 else np.inf
+    columns['cell'][:] = cell
+    return cell, chunk, columns
+
+
+class SweepRunner(object):
+
+    # Sweeps every combination of the values in grid, a dict from initialize() settings to lists of values,
+    # on top of the settings of config, running episodes episodes per cell in chunks of chunkSize into the
+    # directory path. An existing sweep in path is resumed and must have the same settings
+    def __init__(self, path, grid, episodes, seed=None, chunkSize=16, numWorkers=None, policy=greedyPolicy,
+                    **config):
+        self.path = path
+        self.names = list(grid)
+        self.cells = [dict(zip(self.names, values)) for values in itertools.product(*grid.values())]
+        self.episodes = episodes
+        self.chunkSize = chunkSize
+        self.numWorkers = numWorkers if numWorkers is not None else multiprocessing.cpu_count()
+        self.policy = policy
+        self.config = config
+
+        #Cells with the same layout settings share the group of their layout pool
+        groups = {}
+        self.groups = [groups.setdefault(layoutKey(dict(config, **cell)), len(groups)) for cell in self.cells]
+
+        self.layout = dict((name, np.asarray(grid[name]).dtype.str) for name in self.names)
+        self.layout.update(COLUMNS)
+        meta = {'grid': dict((name, np.asarray(values).tolist()) for name, values in grid.items()),
+                'episodes': episodes, 'chunkSize': chunkSize, 'policy': policy.__name__,
+                'config': json.loads(json.dumps(config, default=str)), 'columns': self.layout}
+
+        metaPath = os.path.join(path, 'meta.json')
+        if os.path.exists(metaPath):
+            with open(metaPath) as f:
+                stored = json.load(f)
+            entropy = stored.pop('entropy')
+            if stored != meta:
+                raise ValueError("%s holds a sweep with other settings" % path)
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            entropy = seeding.seedSequence(seed).entropy
+            with open(metaPath, 'w') as f:
+                json.dump(dict(meta, entropy=entropy), f, indent=1)
+        self.root = np.random.SeedSequence(entropy)
+
+        self.done = self.restore()
+
+
+    # Truncates the columns to the rows of the checkpointed chunks, whose (cell, chunk) pairs it returns
+    def restore(self):
+        checkpoints = readCheckpoints(self.path)
+        self.rows = int(checkpoints[-1, 2]) if len(checkpoints) else 0
+        sizes = dict((name, self.rows*np.dtype(dtype).itemsize) for name, dtype in self.layout.items())
+        sizes['chunks'] = checkpoints.nbytes
+        for name, size in sizes.items():
+            filename = os.path.join(self.path, name + '.bin')
+            if os.path.exists(filename):
+                os.truncate(filename, size)
+        return set((int(cell), int(chunk)) for cell, chunk, _ in checkpoints)
+
+
+    # (cell, chunk, first episode, episode count, settings, layout group, root seed, policy) of every
+    # chunk still to run, grouped by layout group
+    def tasks(self):
+        for cell in sorted(range(len(self.cells)), key=self.groups.__getitem__):
+            settings = self.cells[cell]
+            for chunk, first in enumerate(range(0, self.episodes, self.chunkSize)):
+                if (cell, chunk) not in self.done:
+                    yield (cell, chunk, first, min(self.chunkSize, self.episodes - first), dict(self.config, **settings),
+                            self.groups[cell], self.root, self.policy)
+
+
+    # Runs the missing chunks, numWorkers at a time or in this process for numWorkers=0, and appends the
+    # episodes of each as soon as it finishes. Returns the number of episodes run
+    def run(self):
+        files = dict((name, open(os.path.join(self.path, name + '.bin'), 'ab')) for name in self.layout)
+        checkpoint = open(os.path.join(self.path, 'chunks.bin'), 'ab')
+        pool = multiprocessing.Pool(self.numWorkers) if self.numWorkers else None
+        ran = 0
+        try:
+            results = pool.imap_unordered(runChunk, self.tasks()) if pool is not None else map(runChunk, self.tasks())
+            for cell, chunk, columns in results:
+                count = len(columns['episode'])
+                for name in self.names:
+                    columns[name] = np.full(count, self.cells[cell][name])
+                for name, f in files.items():
+                    np.ascontiguousarray(columns[name], dtype=self.layout[name]).tofile(f)
+                    f.flush()
+
+                #A chunk counts as done once all of its rows are written
+                self.rows += count
+                np.array([cell, chunk, self.rows], dtype='<i8').tofile(checkpoint)
+                checkpoint.flush()
+                self.done.add((cell, chunk))
+                ran += count
+        finally:
+            if pool is not None:
+                pool.terminate()
+            for f in files.values():
+                f.close()
+            checkpoint.close()
+        return ran
+
+
+# (cell, chunk, rows written once it was done) of every complete checkpoint entry
+def readCheckpoints(path):
+    filename = os.path.join(path, 'chunks.bin')
+    if not os.path.exists(filename):
+        return np.zeros((0, 3), dtype='<i8')
+    entries = np.fromfile(filename, dtype='<i8')
+    return entries[:len(entries) // 3*3].reshape(-1, 3)
+
+
+# Read-only memory maps of the checkpointed rows of every column of the sweep in path
+def readResults(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    checkpoints = readCheckpoints(path)
+    rows = int(checkpoints[-1, 2]) if len(checkpoints) else 0
+
+    columns = {}
+    for name, dtype in meta['columns'].items():
+        if rows == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='r', shape=(rows,))
+    return columns
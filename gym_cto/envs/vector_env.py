@@ -0,0 +1,291 @@
+import numpy as np
+from gym_cto.envs import core
+from gym_cto.envs import spatial
+from gym_cto.envs import seeding
+from gym_cto.envs import profiling
+from gym_cto.envs.cto_env import CtoEnv
+from gym_cto.envs.ecto_env import eCtoEnv, FIXED_FORMATS
+
+"""
+Batched environments that run many independent CTO/eCTO episodes in lockstep
+
+The state of all episodes lives in stacked arrays of shape (numEnvs, numTargets, 2)
+and (numEnvs, numAgents, 2), so each sub-step is one array pass over every
+episode. The wrapped single environments hold views into these arrays and are
+only used to place entities and to build observations.
+"""
+
+#Methods timed when initialize() is called with profile=True
+PROFILED_PHASES = ('step', 'moveTargets', 'moveAgents', 'calculateRewards', 'observe', 'resetEnv')
+
+class VectorCtoEnv(object):
+    envClass = CtoEnv
+
+    def __init__(self, numEnvs):
+        self.numEnvs = numEnvs
+        self.envs = [self.envClass() for _ in range(numEnvs)]
+        self.profiler = None
+
+
+    # Seeds every wrapped env with its own child stream of seed, so each episode only depends on
+    # the root seed and its env index. Takes effect from the next initialize()
+    def seed(self, seed=None):
+        return [env.seed(child)[0] for env, child in zip(self.envs, seeding.spawn(seed, self.numEnvs))]
+
+
+    # Takes the same keyword arguments as the wrapped environment's initialize()
+    def initialize(self, **kwargs):
+        if kwargs.get('tileSize') is not None:
+            raise ValueError("The vector environments move every target of every env, tileSize is not supported")
+        #Steps run in the batched numpy loop below and return the 4-tuple of the old step API
+        unsupported = [name for name in ('macroStep', 'incremental', 'renderEvery', 'newStepApi')
+                        if kwargs.get(name) not in (None, False)]
+        if kwargs.get('backend', 'numpy') != 'numpy':
+            unsupported.append('backend')
+        if unsupported:
+            raise ValueError("The vector environments do not support %s" % ', '.join(unsupported))
+        #The stacked moves and rewards use the settings of the first env for every env
+        if kwargs.get('schedule') or any(np.ndim(kwargs.get(name, 0)) for name in ('targetSpeed', 'agentSpeed',
+                                                                                    'sensorRange', 'targetMaxStep')):
+            raise ValueError("The vector environments only take settings shared by all entities, without a schedule")
+        self.config = kwargs
+        for env in self.envs:
+            env.initialize(**kwargs)
+
+        first = self.envs[0]
+        self.numTargets = first.numTargets
+        self.numAgents = getattr(first, 'numAgents', 1)
+        self.updateRate = first.updateRate
+        self.episodes = first.episodes
+        self.targetMaxStep = first.targetMaxStep
+        self.targetSpeed = first.targetSpeed
+        self.agentSpeed = first.agentSpeed
+        self.sensorRange = first.sensorRange
+        self.gridWidth = first.gridWidth
+        self.gridHeight = first.gridHeight
+        self.compactRepresentation = first.compactRepresentation
+
+        #Padded and nearest compact observations have a fixed shape and are stacked like non-compact ones
+        self.stackable = not self.compactRepresentation or getattr(first, 'compactFormat', 'list') in FIXED_FORMATS
+
+        self.curr_episode = np.zeros(self.numEnvs, dtype=np.int64)
+        self.curr_step = np.zeros(self.numEnvs, dtype=np.int64)
+
+        #Stacked structure-of-arrays stores in the dtype of the wrapped envs
+        targets = core.EntityState(self.numEnvs*self.numTargets, first.dtype)
+        agents = core.EntityState(self.numEnvs*self.numAgents, first.dtype)
+        self.targetLocations = targets.locations.reshape(self.numEnvs, self.numTargets, 2)
+        self.targetDestinations = targets.destinations.reshape(self.numEnvs, self.numTargets, 2)
+        self.targetSteps = targets.steps.reshape(self.numEnvs, self.numTargets)
+        self.targetPosIncrements = targets.increments.reshape(self.numEnvs, self.numTargets, 2)
+        self.targetStale = targets.stale.reshape(self.numEnvs, self.numTargets)
+        self.agentLocations = agents.locations.reshape(self.numEnvs, self.numAgents, 2)
+        self.agentPosIncrements = agents.increments.reshape(self.numEnvs, self.numAgents, 2)
+        self.agentStale = agents.stale.reshape(self.numEnvs, self.numAgents)
+
+        for b in range(self.numEnvs):
+            self.adoptEnv(b)
+
+        #Stacked float32 observations reused by every step
+        self.observations = None
+        if kwargs.get('preallocate', False) and self.stackable:
+            self.observations = np.zeros((self.numEnvs,) + self.stateShape(), dtype=np.float32)
+
+        #Batched phase timings, the wrapped envs time their own observations
+        self.profiler = profiling.instrument(self, PROFILED_PHASES, kwargs.get('profile', False))
+
+
+    # Timings of the batched phases since initialize(profile=True), see eCtoEnv.stats()
+    def stats(self):
+        return self.profiler.stats() if self.profiler is not None else {}
+
+
+    def clearStats(self):
+        if self.profiler is not None:
+            self.profiler.clear()
+
+
+    def stateShape(self):
+        return (self.numTargets, 2)
+
+
+    # Copies the state of one wrapped env into the stacked arrays and makes the env share them
+    def adoptEnv(self, b):
+        env = self.envs[b]
+        for name in ('targetLocations', 'targetDestinations', 'targetSteps', 'targetPosIncrements', 'targetStale'):
+            getattr(self, name)[b] = getattr(env, name)
+            setattr(env, name, getattr(self, name)[b])
+
+        self.agentLocations[b] = env.agentPosition
+        self.agentPosIncrements[b] = env.agentPosIncrements
+        self.agentStale[b] = env.agentStale
+        env.agentPosition = self.agentLocations[b, 0]
+        env.agentPosIncrements = self.agentPosIncrements[b, 0]
+
+        self.curr_episode[b] = 0
+        self.curr_step[b] = 0
+
+
+    # Pre-generates count initial layouts per env that finished episodes restart from, see
+    # generateLayouts() of the wrapped env
+    def generateLayouts(self, count):
+        for env in self.envs:
+            env.generateLayouts(count)
+
+
+    # Starts a new episode of env b in place
+    def restartEnv(self, b):
+        self.envs[b].restart()
+        self.adoptEnv(b)
+
+
+    # Starts a new episode of env b in place and returns its first observation
+    def resetEnv(self, b):
+        self.restartEnv(b)
+        return self.envs[b].observe()
+
+
+    # Starts a new episode of every env and returns their first observations
+    def reset(self):
+        for b in range(self.numEnvs):
+            self.restartEnv(b)
+        return self.observe()
+
+
+    def observe(self):
+        if self.compactRepresentation:
+            return [env.observe() for env in self.envs]
+
+        inRange = self.targetsInRange()
+        if self.observations is None:
+            return np.where(inRange[..., None], self.targetLocations, 0.0)
+
+        np.copyto(self.observations, np.where(inRange[..., None], self.targetLocations, 0.0))
+        return self.observations
+
+
+    # (numEnvs, numTargets) mask of the targets within sensor range of the agent
+    def targetsInRange(self):
+        offset = self.agentLocations - self.targetLocations
+        return np.sqrt(offset[..., 0]**2 + offset[..., 1]**2) <= self.sensorRange
+
+
+    def calculateRewards(self):
+        return self.targetsInRange().sum(axis=1)
+
+
+    def step(self, actions):
+        actions = np.asarray(actions, dtype='float32').reshape(self.numEnvs, self.numAgents, 2)
+        return self.stepAgents(actions)
+
+
+    def stepAgents(self, actions):
+        if actions.shape != (self.numEnvs, self.numAgents, 2):
+            raise ValueError("Incorrect dimensions of action %s. Action must have destination position for each agent "
+                                "of each env" % (actions.shape,))
+
+        self.curr_episode += 1
+
+        reward = 0
+        self.agentStale[:] = True
+        agentReachedDest = np.zeros((self.numEnvs, self.numAgents), dtype=bool)
+        for _ in range(self.updateRate):
+            self.curr_step += 1
+
+            self.moveTargets()
+            self.moveAgents(actions, agentReachedDest)
+
+            reward = reward + self.calculateRewards()
+
+        obs = self.observe()
+        dones = self.curr_episode >= self.episodes
+        infos = self.stateInfos()
+
+        #Auto-reset finished episodes, the last observation goes to info
+        for b in np.flatnonzero(dones):
+            infos[b]['terminal_observation'] = obs[b].copy() if self.stackable else obs[b]
+            obs[b] = self.resetEnv(b)
+
+        return obs, reward, dones, infos
+
+
+    def stateInfos(self):
+        return [{} for _ in range(self.numEnvs)]
+
+
+    def moveTargets(self):
+        reroute = core.rerouteMask(self.targetLocations, self.targetDestinations, self.targetSteps)
+        if reroute.any():
+            #Each env draws from its own stream
+            for b in np.flatnonzero(reroute.any(axis=1)):
+                self.targetDestinations[b, reroute[b]] = self.envs[b].randomPoints(np.count_nonzero(reroute[b]))
+            self.targetSteps[reroute] = self.targetMaxStep
+            self.targetStale[reroute] = True
+
+        core.advance(self.targetLocations, self.targetPosIncrements, self.targetStale, self.targetDestinations,
+                        self.targetSpeed, self.gridWidth, self.gridHeight)
+        self.targetSteps -= 1
+
+
+    def moveAgents(self, dest, reachedDest):
+        core.advance(self.agentLocations, self.agentPosIncrements, self.agentStale, dest,
+                        self.agentSpeed, self.gridWidth, self.gridHeight)
+
+        #Already reached. Removes precision errors
+        self.agentLocations[reachedDest] = dest[reachedDest]
+        reachedDest |= core.arrived(self.agentLocations, dest)
+
+
+class VectorECtoEnv(VectorCtoEnv):
+    envClass = eCtoEnv
+
+    def adoptEnv(self, b):
+        env = self.envs[b]
+        for name in ('targetLocations', 'targetDestinations', 'targetSteps', 'targetPosIncrements', 'targetStale',
+                        'agentLocations', 'agentPosIncrements', 'agentStale'):
+            getattr(self, name)[b] = getattr(env, name)
+            setattr(env, name, getattr(self, name)[b])
+
+        self.curr_episode[b] = 0
+        self.curr_step[b] = 0
+
+
+    def stateShape(self):
+        return self.envs[0].stateShape()
+
+
+    # The envs' positions are views of the stacked arrays moved by the sub-steps, so their cached pairs are stale
+    def observe(self):
+        for env in self.envs:
+            env.invalidatePairs()
+        if not self.stackable:
+            return [env.observe() for env in self.envs]
+
+        obs = self.observations
+        if obs is None:
+            obs = np.zeros((self.numEnvs,) + self.stateShape(), dtype=self.envs[0].observationDtype)
+        for env, out in zip(self.envs, obs):
+            env.observe(out=out)
+        return obs
+
+
+    # Masks and counts of padded observations, offsets of csr ones
+    def stateInfos(self):
+        return [dict(env.stateInfo()) for env in self.envs]
+
+
+    # Nearest-observer rewards of every env from one grid query over all episodes
+    def calculateRewards(self):
+        grid = spatial.UniformGrid(self.sensorRange, self.gridWidth, self.gridHeight)
+        targetIdx, agentIdx, dist = spatial.pairsWithin(grid, self.targetLocations.reshape(-1, 2),
+                                                        self.agentLocations.reshape(-1, 2), self.sensorRange,
+                                                        np.repeat(np.arange(self.numEnvs), self.numTargets),
+                                                        np.repeat(np.arange(self.numEnvs), self.numAgents))
+
+        reward, _ = spatial.nearestObserver(targetIdx, agentIdx, dist, self.numEnvs*self.numTargets,
+                                            self.numEnvs*self.numAgents)
+        return reward.reshape(self.numEnvs, self.numAgents)
+
+
+    def step(self, actions):
+        return self.stepAgents(np.asarray(actions, dtype='float32'))
@@ -3,5 +3,6 @@ from setuptools import setup
 
 setup(name='gym_cto',
       version='0.0.1',
-      install_requires=['gym']
+      install_requires=['gym', 'numpy>=1.17'],
+      extras_require={'jit': ['numba']}
 )
\ No newline at end of file
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from gym_cto.envs import eCtoEnv
+
+"""
+The numba backend reproduces the numpy backend step for step
+"""
+
+pytest.importorskip('numba')
+
+SETTINGS = [
+    {},
+    {'mark': True, 'sensorRange': 30},
+    {'targets': 60, 'agents': 8, 'updateRate': 25, 'targetMaxStep': 20, 'targetSpeed': 2.0},
+    {'compact': True, 'compactFormat': 'padded', 'mark': True, 'sensorRange': 40},
+    {'dtype': np.float32},
+    {'dtype': np.float32, 'targets': 60, 'agents': 8, 'updateRate': 25, 'targetMaxStep': 20, 'targetSpeed': 2.0},
+]
+
+
+@pytest.mark.parametrize('settings', SETTINGS)
+def test_numba_matches_numpy(settings):
+    envs = []
+    for backend in ('numpy', 'numba'):
+        env = eCtoEnv()
+        env.seed(11)
+        env.initialize(backend=backend, **settings)
+        env.reset()
+        envs.append(env)
+
+    rng = np.random.default_rng(5)
+    for _ in range(30):
+        action = rng.uniform(0.0, (envs[0].gridWidth, envs[0].gridHeight), size=(envs[0].numAgents, 2))
+        (obs, reward, _, _), (otherObs, otherReward, _, _) = [env.step(action) for env in envs]
+        assert np.array_equal(reward, otherReward)
+        assert np.array_equal(obs, otherObs)
+        assert np.array_equal(envs[0].targetLocations, envs[1].targetLocations)
+        assert np.array_equal(envs[0].agentLocations, envs[1].agentLocations)
+        assert envs[0].np_random.bit_generator.state == envs[1].np_random.bit_generator.state
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from gym_cto.envs import eCtoEnv
+
+"""
+Scheduled settings give the same episodes through the range queries as through the brute-force path
+"""
+
+SCHEDULES = [
+    {5: {'sensorRange': 40.0}},
+    {2: {'sensorRange': 40.0}, 4: {'sensorRange': 10.0, 'targetSpeed': 2.0}},
+]
+
+QUERIES = [{}, {'incremental': True}, {'macroStep': True}]
+
+
+@pytest.mark.parametrize('schedule', SCHEDULES)
+@pytest.mark.parametrize('queries', QUERIES)
+def test_schedule_matches_brute_force(schedule, queries):
+    envs = []
+    for settings in ({'spatialIndex': False}, queries):
+        env = eCtoEnv()
+        env.seed(3)
+        env.initialize(targets=200, agents=10, sensorRange=15, mark=True, schedule=schedule, **settings)
+        envs.append(env)
+
+    assert np.array_equal(envs[0].reset(), envs[1].reset())
+    rng = np.random.default_rng(4)
+    for _ in range(8):
+        action = rng.uniform(0.0, 150.0, size=(10, 2))
+        (obs, reward, _, _), (otherObs, otherReward, _, _) = [env.step(action) for env in envs]
+        assert np.array_equal(reward, otherReward)
+        assert np.array_equal(obs, otherObs)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from gym_cto.envs import CtoEnv, eCtoEnv
+
+"""
+Every observation of the envs lies in their observation_space
+"""
+
+ECTO_SETTINGS = [
+    {},
+    {'mark': True},
+    {'compact': True},
+    {'compact': True, 'mark': True, 'spatialIndex': False},
+    {'compact': True, 'compactFormat': 'padded'},
+    {'compact': True, 'compactFormat': 'padded', 'compactSize': 3, 'mark': True},
+    {'compact': True, 'compactFormat': 'csr', 'mark': True},
+    {'compact': True, 'compactFormat': 'nearest', 'compactSize': 4},
+    {'compact': True, 'compactFormat': 'csr', 'relative': True, 'obsDtype': np.float16},
+    {'compact': True, 'compactFormat': 'list', 'relative': True},
+]
+
+
+# Observations of reset() and a few steps towards random destinations
+def observations(env, steps=5):
+    yield env.reset(seed=7)
+    for _ in range(steps):
+        yield env.step(env.action_space.sample())[0]
+
+
+@pytest.mark.parametrize('settings', ECTO_SETTINGS)
+def test_ecto_observations_in_space(settings):
+    env = eCtoEnv()
+    env.initialize(sensorRange=40, **settings)
+    env.action_space.seed(0)
+    for obs in observations(env):
+        assert env.observation_space.contains(obs)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_cto_observations_in_space(compact):
+    env = CtoEnv()
+    env.initialize(sensorRange=40, compact=compact)
+    env.action_space.seed(0)
+    for obs in observations(env):
+        assert env.observation_space.contains(obs)